@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+"""
+Microbenchmark of checking USE flag combinations against REQUIRED_USE.
+
+Compares portage.dep.check_required_use() on flag lists, like
+get_use_combinations() used to do for every candidate, with membership tests
+of precompiled and memoized REQUIRED_USE (RequiredUseSolver).
+
+    python benchmarks/bench_required_use.py [--candidates N]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+import portage
+
+# Use the package of this checkout, also when it is not installed.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pkg_testing_tools.solver import get_required_use_solver  # noqa: E402
+from pkg_testing_tools.use import (  # noqa: E402
+    get_use_flags_toggles,
+    iuse_match_always_true,
+)
+
+CASES = {
+    "small": (
+        ["gtk", "qt5", "ssl", "gnutls", "openssl"],
+        ["?? ( gtk qt5 )", "ssl? ( ^^ ( gnutls openssl ) )"],
+    ),
+    "firefox-like": (
+        sorted(
+            ["clang", "dbus", "eme-free", "hardened", "hwaccel", "jack", "libproxy"]
+            + ["lto", "openh264", "pgo", "pulseaudio", "sndio", "system-av1"]
+            + ["system-harfbuzz", "system-icu", "system-jpeg", "system-libevent"]
+            + ["system-libvpx", "system-png", "system-python-libs", "system-webp"]
+            + ["telemetry", "valgrind", "wayland", "wifi", "X"]
+            + ["geckodriver", "gmp-autoupdate", "jumbo-build", "screencast"]
+            + ["llvm_slot_17", "llvm_slot_18", "llvm_slot_19"]
+        ),
+        [
+            "|| ( X wayland )",
+            "debug? ( !system-av1 )",
+            "pgo? ( lto )",
+            "wifi? ( dbus )",
+            "^^ ( llvm_slot_17 llvm_slot_18 llvm_slot_19 )",
+            "screencast? ( wayland )",
+        ],
+    ),
+}
+
+
+def bench(function, candidates):
+    started = time.perf_counter()
+    valid = 0
+    for candidate in candidates:
+        valid += bool(function(candidate))
+    return time.perf_counter() - started, valid
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--candidates", type=int, default=20000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+
+    print(
+        "{:<14} {:>6} {:>12} {:>12} {:>12} {:>9}".format(
+            "case", "flags", "compile [s]", "portage [s]", "solver [s]", "speedup"
+        )
+    )
+
+    for name, (iuse, ruse) in CASES.items():
+        indices = [rng.randrange(2 ** len(iuse)) for _ in range(args.candidates)]
+        ruse_string = " ".join(ruse)
+
+        def check_portage(index):
+            return portage.dep.check_required_use(
+                ruse_string, get_use_flags_toggles(index, iuse), iuse_match_always_true
+            )
+
+        started = time.perf_counter()
+        solver = get_required_use_solver(iuse, ruse)
+        compile_time = time.perf_counter() - started
+
+        portage_time, portage_valid = bench(check_portage, indices)
+        solver_time, solver_valid = bench(solver.__contains__, indices)
+
+        assert portage_valid == solver_valid
+
+        print(
+            "{:<14} {:>6} {:>12.4f} {:>12.4f} {:>12.4f} {:>8.0f}x".format(
+                name,
+                len(iuse),
+                compile_time,
+                portage_time,
+                solver_time,
+                portage_time / solver_time,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
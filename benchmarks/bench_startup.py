@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of the startup time of pkg-testing-tool.
+
+Times importing pkg_testing_tools.main, '--help' and an argument error in fresh
+interpreters, on top of the startup of the interpreter itself, and checks that
+none of them imports portage.
+
+    python benchmarks/bench_startup.py [--repeat N] [--max-ms MS]
+
+Exits with status 1 if portage was imported or any case took longer than --max-ms.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+# Fresh interpreters run in the checkout, so that they import its package, also when it is not installed.
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run in a fresh interpreter, exit status 3 tells that portage was imported.
+STARTUP_CODE = """
+import sys
+from pkg_testing_tools.main import run
+if {argv!r} is not None:
+    try:
+        run({argv!r})
+    except SystemExit:
+        pass
+sys.exit(3 if "portage" in sys.modules else 0)
+"""
+
+# Command lines to start with, None to only import pkg_testing_tools.main.
+CASES = {
+    "import": None,
+    "--help": ["--help"],
+    "argument error": ["-p", "a/b", "--parallel", "2", "--unmerge"],
+}
+
+
+def time_command(code, repeat):
+    """
+    Best wall time of running code in a fresh interpreter, and its exit status.
+    """
+    best = None
+    returncode = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        returncode = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=REPO_ROOT,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        ).returncode
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, returncode
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument(
+        "--max-ms",
+        type=float,
+        default=100,
+        help="Fail if a case takes longer than this on top of the interpreter startup.",
+    )
+    args = parser.parse_args()
+
+    interpreter, _ = time_command("pass", args.repeat)
+    print("{:<16} {:>10}".format("interpreter", "{:.1f} ms".format(interpreter * 1000)))
+
+    failures = []
+    for name, argv in CASES.items():
+        elapsed, returncode = time_command(STARTUP_CODE.format(argv=argv), args.repeat)
+        overhead = (elapsed - interpreter) * 1000
+        print(
+            "{:<16} {:>10} {:>+10.1f} ms".format(
+                name, "{:.1f} ms".format(elapsed * 1000), overhead
+            )
+        )
+
+        if returncode == 3:
+            failures.append("{} imports portage".format(name))
+        elif returncode != 0:
+            failures.append("{} failed with exit status {}".format(name, returncode))
+        if overhead > args.max_ms:
+            failures.append("{} took {:.1f} ms".format(name, overhead))
+
+    for failure in failures:
+        print("FAILED {}".format(failure))
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
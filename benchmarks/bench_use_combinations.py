@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of USE combination generation on real-world and synthetic IUSE/REQUIRED_USE.
+
+Measures time and peak memory of get_use_combination_indices() in random, sparse,
+dense and exhaustive modes, of the sparse and dense searches over
+yield_use_flags_toggles_sorted_split() that get_use_combinations() used to do,
+and of rendering combinations with get_use_flags_toggles(), for the packages of
+corpus/required_use.json and for synthetic REQUIRED_USE with growing flag counts.
+
+Every measurement compiles REQUIRED_USE from scratch. Runs offline, with a stub
+for portage.dep.check_required_use() when portage is not installed.
+
+    python benchmarks/bench_use_combinations.py [--save results.json] [--baseline results.json]
+
+With --baseline, exits with status 1 if any measurement is slower or uses more
+memory than the baseline by more than --tolerance.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+import portage_stub
+
+portage_stub.install()
+
+# Use the package of this checkout, also when it is not installed.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import portage  # noqa: E402
+
+from pkg_testing_tools.solver import (  # noqa: E402
+    _get_required_use_solver,
+    get_required_use_solver,
+)
+from pkg_testing_tools.use import (  # noqa: E402
+    get_package_flags,
+    get_use_combination_indices,
+    get_use_flags_toggles,
+    iuse_match_always_true,
+    yield_use_flags_toggles_sorted_split,
+)
+
+CORPUS_PATH = os.path.join(os.path.dirname(__file__), "corpus", "required_use.json")
+
+# Slowdowns up to this many seconds are noise, whatever the tolerance.
+MIN_COMPARED_TIME = 0.001
+
+
+def load_corpus(path):
+    with open(path) as corpus:
+        packages = json.load(corpus)["packages"]
+
+    return {
+        package["cpv"]: get_package_flags(
+            package["cpv"], [package["IUSE"], package["REQUIRED_USE"]]
+        )
+        for package in packages
+    }
+
+
+def get_synthetic_case(flag_count):
+    """
+    IUSE and REQUIRED_USE shaped like the corpus: exclusive groups, implications
+    and conflicts between nearby flags, and a few '||' groups across the whole IUSE.
+
+    >>> iuse, ruse = get_synthetic_case(8)
+    >>> len(iuse), get_required_use_solver(iuse, ruse).count() > 0
+    (8, True)
+    """
+    rng = random.Random(flag_count)
+    iuse = ["flag{:03d}".format(i) for i in range(flag_count)]
+    ruse = []
+
+    for start in range(0, flag_count - 7, 8):
+        block = iuse[start : start + 8]
+        group = rng.sample(block, 3)
+        ruse.append("{} ( {} )".format(rng.choice(["^^", "??"]), " ".join(group)))
+        condition, required, conflicting = rng.sample(block, 3)
+        ruse.append("{}? ( {} )".format(condition, required))
+        ruse.append("{}? ( !{} )".format(required, conflicting))
+
+    for _ in range(flag_count // 16):
+        ruse.append("|| ( {} )".format(" ".join(rng.sample(iuse, 2))))
+
+    return iuse, ruse
+
+
+def find_extreme_legacy(iuse, ruse, limit, inverted=False):
+    """
+    First valid combination in the order of yield_use_flags_toggles_sorted_split(),
+    checked one by one with portage.dep.check_required_use(), or None if none of
+    the first limit candidates is valid.
+    """
+    iuse_sorted = [use for use in iuse if "single_target" not in use]
+    iuse_unsorted = [use for use in iuse if "single_target" in use]
+    ruse_string = " ".join(ruse)
+
+    for use_flags in itertools.islice(
+        yield_use_flags_toggles_sorted_split(iuse_sorted, iuse_unsorted, inverted),
+        limit,
+    ):
+        if portage.dep.check_required_use(
+            ruse_string, use_flags, iuse_match_always_true
+        ):
+            return use_flags
+
+    return None
+
+
+def measure(function, repeat):
+    """
+    Best time out of repeat runs, and peak memory allocated during one more run,
+    compiling REQUIRED_USE from scratch every time.
+
+    :return: (seconds, bytes, return value of function)
+    """
+    best = None
+    for _ in range(repeat):
+        _get_required_use_solver.cache_clear()
+        started = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    _get_required_use_solver.cache_clear()
+    tracemalloc.start()
+    try:
+        value = function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return best, peak, value
+
+
+def get_modes(iuse, ruse, args):
+    """
+    Benchmarked modes of a package, as name: function returning the number of results.
+    """
+    rng_seed = "{}:{}".format(args.seed, " ".join(iuse))
+    count = get_required_use_solver(iuse, ruse).count()
+
+    modes = {
+        "random": lambda: len(
+            get_use_combination_indices(
+                iuse, ruse, args.max_use_combinations, rng=random.Random(rng_seed)
+            )
+        ),
+        "sparse": lambda: len(
+            get_use_combination_indices(iuse, ruse, 1, add_sparse_use=True)
+        ),
+        "dense": lambda: len(
+            get_use_combination_indices(iuse, ruse, 1, add_dense_use=True)
+        ),
+    }
+
+    if count <= args.max_exhaustive:
+        modes["exhaustive"] = lambda: len(get_use_combination_indices(iuse, ruse, -1))
+
+    # 0 results: gave up after --legacy-limit candidates.
+    modes["sparse-legacy"] = lambda: int(
+        find_extreme_legacy(iuse, ruse, args.legacy_limit) is not None
+    )
+    modes["dense-legacy"] = lambda: int(
+        find_extreme_legacy(iuse, ruse, args.legacy_limit, inverted=True) is not None
+    )
+
+    indices = [random.Random(rng_seed).getrandbits(len(iuse)) for _ in range(1000)]
+    modes["toggles"] = lambda: len(
+        [get_use_flags_toggles(index, iuse) for index in indices]
+    )
+
+    return modes
+
+
+def check_regressions(results, baseline, tolerance):
+    """
+    :return: descriptions of the measurements that regressed
+
+    >>> check_regressions({"a": {"time": 0.5, "peak": 1024}}, {"a": {"time": 0.2, "peak": 1024}}, 0.25)
+    ['a: 0.5000 s, was 0.2000 s']
+    """
+    regressions = []
+
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+
+        before = baseline[key]
+        if result["time"] > before["time"] * (1 + tolerance) + MIN_COMPARED_TIME:
+            regressions.append(
+                "{}: {:.4f} s, was {:.4f} s".format(key, result["time"], before["time"])
+            )
+        if result["peak"] > before["peak"] * (1 + tolerance):
+            regressions.append(
+                "{}: {:.0f} KiB peak, was {:.0f} KiB".format(
+                    key, result["peak"] / 1024, before["peak"] / 1024
+                )
+            )
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", default=CORPUS_PATH)
+    parser.add_argument(
+        "--flag-counts",
+        default="8,16,32,64,128",
+        help="Flag counts of the synthetic cases, comma separated, empty for none.",
+    )
+    parser.add_argument("--max-use-combinations", type=int, default=16)
+    parser.add_argument(
+        "--max-exhaustive",
+        type=int,
+        default=2**16,
+        help="Skip the exhaustive mode for packages with more valid combinations.",
+    )
+    parser.add_argument(
+        "--legacy-limit",
+        type=int,
+        default=10000,
+        help="Give up the legacy sparse/dense searches after this many candidates.",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", default="0")
+    parser.add_argument("--filter", help="Only run cases containing this string.")
+    parser.add_argument("--save", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare the results to this JSON file.")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Allowed slowdown and memory growth over the baseline, as a fraction.",
+    )
+    args = parser.parse_args()
+
+    cases = load_corpus(args.corpus)
+    for flag_count in filter(None, args.flag_counts.split(",")):
+        cases["synthetic-{}".format(flag_count)] = get_synthetic_case(int(flag_count))
+
+    if args.filter:
+        cases = {name: case for name, case in cases.items() if args.filter in name}
+
+    print(
+        "{:<32} {:>5} {:<14} {:>10} {:>10} {:>8}".format(
+            "case", "flags", "mode", "time [s]", "peak [KiB]", "results"
+        )
+    )
+
+    results = {}
+    for name, (iuse, ruse) in cases.items():
+        for mode, function in get_modes(iuse, ruse, args).items():
+            elapsed, peak, value = measure(function, args.repeat)
+            results["{}/{}".format(name, mode)] = {
+                "flags": len(iuse),
+                "time": elapsed,
+                "peak": peak,
+                "results": value,
+            }
+            print(
+                "{:<32} {:>5} {:<14} {:>10.4f} {:>10.0f} {:>8}".format(
+                    name, len(iuse), mode, elapsed, peak / 1024, value
+                )
+            )
+
+    if args.save:
+        with open(args.save, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = check_regressions(
+                results, json.load(baseline), args.tolerance
+            )
+
+        for regression in regressions:
+            print("REGRESSION {}".format(regression))
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
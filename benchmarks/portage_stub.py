@@ -0,0 +1,76 @@
+"""
+Minimal stand-in for the parts of portage the benchmarks touch, so that they
+run on machines without portage. Only installed when portage cannot be imported.
+
+    >>> from portage_stub import check_required_use
+    >>> bool(check_required_use("^^ ( a b ) c? ( a )", ["a", "-b", "c"], None))
+    True
+    >>> bool(check_required_use("^^ ( a b ) c? ( a )", ["-a", "b", "c"], None))
+    False
+"""
+
+import sys
+import types
+
+
+class InvalidDependString(Exception):
+    pass
+
+
+def evaluate(node, use):
+    operator, argument = node
+
+    if operator == "flag":
+        negated = argument.startswith("!")
+        return (argument.lstrip("!") in use) != negated
+
+    values = [evaluate(child, use) for child in argument]
+
+    if operator == "()":
+        return all(values)
+    if operator == "||":
+        return any(values)
+    if operator == "^^":
+        return sum(values) == 1
+    if operator == "??":
+        return sum(values) <= 1
+
+    # Conditional group, 'flag?' or '!flag?'.
+    condition = operator[:-1]
+    negated = condition.startswith("!")
+    if (condition.lstrip("!") in use) == negated:
+        return True
+    return all(values)
+
+
+def check_required_use(required_use, use, iuse_match, eapi=None):
+    """
+    Same verdict as portage.dep.check_required_use(), for flags in IUSE.
+    """
+    from pkg_testing_tools.solver import parse_required_use
+
+    use = frozenset(use)
+    return all(evaluate(node, use) for node in parse_required_use([required_use]))
+
+
+def install():
+    """
+    Register the stub as the portage module, unless portage is available.
+    """
+    try:
+        import portage  # noqa: F401
+
+        return False
+    except ImportError:
+        pass
+
+    portage = types.ModuleType("portage")
+    portage.dep = types.ModuleType("portage.dep")
+    portage.dep.check_required_use = check_required_use
+    portage.exception = types.ModuleType("portage.exception")
+    portage.exception.InvalidDependString = InvalidDependString
+
+    sys.modules["portage"] = portage
+    sys.modules["portage.dep"] = portage.dep
+    sys.modules["portage.exception"] = portage.exception
+    return True
@@ -0,0 +1,221 @@
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import threading
+from contextlib import contextmanager
+
+from .portage_api import get_portage, get_settings
+
+# Variables that change the binary packages built from the same ebuild and USE flags,
+# which portage does not check when it picks a binary package.
+BUILD_VARIABLES = [
+    "ARCH",
+    "CHOST",
+    "CBUILD",
+    "CFLAGS",
+    "CXXFLAGS",
+    "FFLAGS",
+    "FCFLAGS",
+    "LDFLAGS",
+    "RUSTFLAGS",
+]
+
+# Suffixes of binary packages in PKGDIR.
+BINPKG_SUFFIXES = (".gpkg.tar", ".xpak", ".tbz2")
+
+
+def get_build_key(variables, profiles):
+    """
+    Key of a build environment: the values of BUILD_VARIABLES and the profiles.
+
+    :param variables: mapping with the values of BUILD_VARIABLES, like portage.settings
+
+    >>> get_build_key({"CFLAGS": "-O2"}, []) == get_build_key({"CFLAGS": "-O2", "USE": "x"}, [])
+    True
+    >>> get_build_key({"CFLAGS": "-O2"}, []) == get_build_key({"CFLAGS": "-O3"}, [])
+    False
+    """
+    key = hashlib.sha1()
+    for name in BUILD_VARIABLES:
+        key.update("{}={}\n".format(name, variables.get(name, "")).encode())
+    for profile in profiles:
+        key.update("profile={}\n".format(os.path.realpath(profile)).encode())
+    return key.hexdigest()[:16]
+
+
+def is_package_file(name, pf):
+    """
+    Whether name is a binary package of pf, with or without binpkg-multi-instance.
+
+    >>> [is_package_file(name, "foo-1.0") for name in ["foo-1.0-3.gpkg.tar", "foo-1.0.tbz2", "foo-1.0-r1-1.xpak"]]
+    [True, True, False]
+    """
+    return (
+        re.fullmatch(
+            re.escape(pf)
+            + r"(-\d+)?("
+            + "|".join(map(re.escape, BINPKG_SUFFIXES))
+            + ")",
+            name,
+        )
+        is not None
+    )
+
+
+class BinpkgCache:
+    """
+    Binary packages shared by all jobs and sessions, in a PKGDIR per build environment
+    (see get_build_key()) under root. Portage keeps binary packages of the same cpv
+    with different USE flags next to each other (FEATURES=binpkg-multi-instance, turned
+    on by set_env() in case it was disabled) and only installs those with matching USE flags.
+
+    The whole cache is kept under max_size bytes by removing the binary packages
+    that were used least recently. Jobs hold a shared lock on it while emerge runs,
+    packages are only removed under an exclusive lock.
+    """
+
+    def __init__(self, root, max_size, build_key=None):
+        self.root = root
+        self.max_size = max_size
+        if build_key is None:
+            settings = get_settings()
+            build_key = get_build_key(settings, settings.profiles)
+        self.pkgdir = os.path.join(root, build_key)
+        self.lock_path = os.path.join(root, ".lock")
+        self.hits = 0
+        self.misses = 0
+        self.counts_lock = threading.Lock()
+        os.makedirs(self.pkgdir, exist_ok=True)
+
+    @contextmanager
+    def lock(self, operation):
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, operation)
+            yield
+        finally:
+            os.close(fd)
+
+    def set_env(self, env):
+        """
+        Make emerge run with env use the cache as PKGDIR.
+        """
+        env["PKGDIR"] = self.pkgdir
+        # Otherwise binary packages with other USE flags replace each other.
+        env["FEATURES"] = " ".join(
+            filter(None, [env.get("FEATURES"), "binpkg-multi-instance"])
+        )
+
+    def use(self):
+        """
+        Context manager held while emerge reads and writes binary packages.
+        """
+        return self.lock(fcntl.LOCK_SH)
+
+    def get_package_files(self, cpv):
+        """
+        Binary packages of cpv in the PKGDIR of this build environment.
+        """
+        category, pn, _, _ = get_portage().versions.catpkgsplit(cpv)
+        pf = cpv.split("/", 1)[1]
+        paths = []
+        # Directly in the category directory, or in a directory per package with binpkg-multi-instance.
+        for directory in [
+            os.path.join(self.pkgdir, category),
+            os.path.join(self.pkgdir, category, pn),
+        ]:
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+            paths.extend(
+                os.path.join(directory, name)
+                for name in names
+                if is_package_file(name, pf)
+            )
+        return paths
+
+    def record(self, binary, source):
+        """
+        Count the packages a job installed from the cache (hits) and built from source
+        (misses), and mark the ones used as recently used.
+
+        :param binary: cpvs of the packages installed from binary packages
+        :param source: cpvs of the packages built from source
+        """
+        with self.counts_lock:
+            self.hits += len(binary)
+            self.misses += len(source)
+
+        for cpv in binary:
+            for path in self.get_package_files(cpv):
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+
+    def evict(self, blocking=True):
+        """
+        Remove the least recently used binary packages until the cache fits in max_size.
+
+        :param blocking: wait for running jobs, otherwise skip eviction while the cache is in use
+        """
+        try:
+            with self.lock(fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB)):
+                self._evict()
+        except BlockingIOError:
+            logging.debug("Binary package cache in use, not evicting.")
+
+    def _evict(self):
+        packages = []
+        size = 0
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                if not name.endswith(BINPKG_SUFFIXES):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                packages.append((stat.st_mtime, stat.st_size, path))
+                size += stat.st_size
+
+        if size <= self.max_size:
+            return
+
+        removed = 0
+        for _, package_size, path in sorted(packages):
+            if size <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            size -= package_size
+            removed += 1
+
+        # Portage drops packages whose file is gone from the Packages index when it reads it.
+        logging.info(
+            "Removed {} binary packages from {}, {:.1f} GiB left.".format(
+                removed, self.root, size / 1024**3
+            )
+        )
+
+
+def get_binpkg_cache(cache_dir, max_size):
+    """
+    Open the binary package cache in cache_dir, or return None if that is not possible.
+    """
+    root = os.path.join(cache_dir, "binpkgs")
+    try:
+        return BinpkgCache(root, max_size)
+    except OSError as e:
+        logging.warning(
+            "Could not open binary package cache in {}, continuing without: {}".format(
+                root, e
+            )
+        )
+        return None
@@ -0,0 +1,387 @@
+import datetime
+import functools
+import glob
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from .portage_api import get_portage, get_portdb, get_settings
+from .report import get_report_cp, get_report_duration
+
+# Everything get_package_metadata() needs, fetched with a single aux_get().
+METADATA_KEYS = ["IUSE", "REQUIRED_USE", "DEFINED_PHASES"]
+
+
+@functools.lru_cache(maxsize=None)
+def get_eclasses_fingerprint(eclass_location):
+    """
+    Fingerprint of all eclasses in a directory, based on their names, mtimes and sizes.
+    """
+    fingerprint = hashlib.sha1()
+    for path in sorted(glob.glob(os.path.join(eclass_location, "*.eclass"))):
+        stat = os.stat(path)
+        fingerprint.update(
+            "{} {} {}\n".format(path, stat.st_mtime_ns, stat.st_size).encode()
+        )
+    return fingerprint.hexdigest()
+
+
+def get_metadata_key(cpv):
+    """
+    Key that changes whenever the metadata of cpv might have changed.
+
+    It covers the ebuild, its md5-cache entry and the eclasses of its repository
+    (and its masters).
+
+    :param cpv: package, like 'app-category/foo-1.2.3'
+    :return: key, or None if the ebuild cannot be found
+    """
+    portdb = get_portdb()
+    ebuild_path, repo_location = portdb.findname2(cpv)
+
+    if ebuild_path is None:
+        return None
+
+    key = hashlib.sha1()
+    ebuild_stat = os.stat(ebuild_path)
+    key.update(
+        "{} {} {}\n".format(
+            ebuild_path, ebuild_stat.st_mtime_ns, ebuild_stat.st_size
+        ).encode()
+    )
+
+    md5_cache_path = os.path.join(repo_location, "metadata", "md5-cache", cpv)
+    if os.path.exists(md5_cache_path):
+        md5_cache_stat = os.stat(md5_cache_path)
+        key.update(
+            "{} {}\n".format(
+                md5_cache_stat.st_mtime_ns, md5_cache_stat.st_size
+            ).encode()
+        )
+
+    repo = portdb.repositories.get_repo_for_location(repo_location)
+    for eclass_location in repo.eclass_locations or []:
+        key.update(get_eclasses_fingerprint(eclass_location).encode())
+
+    return key.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def get_config_fingerprint():
+    """
+    Fingerprint of the portage configuration, i.e. the profiles and /etc/portage,
+    based on their file names, mtimes and sizes.
+
+    Temporary files of pkg-testing-tool in /etc/portage are left out, as they change every run.
+    """
+    fingerprint = hashlib.sha1()
+    settings = get_settings()
+    locations = list(settings.profiles) + [
+        os.path.join(
+            settings["PORTAGE_CONFIGROOT"], get_portage().const.USER_CONFIG_PATH
+        )
+    ]
+
+    for location in locations:
+        fingerprint.update("{}\n".format(location).encode())
+        for directory, directories, files in os.walk(location):
+            directories.sort()
+            for name in sorted(files):
+                if name.startswith("zzz_pkg_testing_tool_"):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                fingerprint.update(
+                    "{} {} {}\n".format(path, stat.st_mtime_ns, stat.st_size).encode()
+                )
+
+    return fingerprint.hexdigest()
+
+
+def get_inputs_key(cpv):
+    """
+    Key that changes whenever the outcome of testing cpv might have changed,
+    i.e. its metadata (see get_metadata_key()) or the portage configuration.
+
+    :param cpv: package, like 'app-category/foo-1.2.3'
+    :return: key, or None if the ebuild cannot be found
+    """
+    metadata_key = get_metadata_key(cpv)
+
+    if metadata_key is None:
+        return None
+
+    return hashlib.sha1(
+        "{} {}".format(metadata_key, get_config_fingerprint()).encode()
+    ).hexdigest()
+
+
+def normalize_use_flags(use_flags):
+    """
+    Normalize USE flags as reported in results, so the same set always gives the same string.
+
+    >>> normalize_use_flags("b -a c")
+    '-a b c'
+    >>> normalize_use_flags("")
+    ''
+    """
+    return " ".join(sorted(use_flags.split()))
+
+
+class MetadataCache:
+    """
+    Persistent SQLite cache of the ebuild metadata in METADATA_KEYS, keyed on cpv.
+
+    Entries are only used as long as get_metadata_key() of the cpv is unchanged.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS metadata (cpv TEXT PRIMARY KEY, key TEXT NOT NULL, {})".format(
+                ", ".join("{} TEXT NOT NULL".format(name) for name in METADATA_KEYS)
+            )
+        )
+        self.connection.commit()
+
+    def aux_get(self, cpv):
+        """
+        Get the values of METADATA_KEYS for cpv, from the cache if it is still valid.
+        """
+        key = get_metadata_key(cpv)
+
+        if key is not None:
+            row = self.connection.execute(
+                "SELECT key, {} FROM metadata WHERE cpv = ?".format(
+                    ", ".join(METADATA_KEYS)
+                ),
+                (str(cpv),),
+            ).fetchone()
+            if row is not None and row[0] == key:
+                logging.debug("metadata of {} found in cache".format(cpv))
+                return list(row[1:])
+
+        values = get_portdb().aux_get(cpv, METADATA_KEYS)
+
+        if key is not None:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO metadata VALUES (?, ?, {})".format(
+                    ", ".join("?" for _ in METADATA_KEYS)
+                ),
+                [str(cpv), key] + list(values),
+            )
+            self.connection.commit()
+
+        return values
+
+    def close(self):
+        self.connection.close()
+
+
+# Every run, with its whole report entry, and its USE flags (as 'flag' or '-flag')
+# indexed on their own, so that queries by package, flag, outcome and time are fast.
+# started is 0 for entries without time, NULL would make them all distinct to UNIQUE.
+RUNS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY, atom TEXT NOT NULL, cp TEXT NOT NULL,
+    use_flags TEXT NOT NULL, test_feature_toggle INTEGER NOT NULL,
+    exit_code INTEGER NOT NULL, started REAL NOT NULL, duration REAL, entry TEXT NOT NULL,
+    UNIQUE (atom, use_flags, test_feature_toggle, started));
+CREATE TABLE IF NOT EXISTS run_use_flags (
+    flag TEXT NOT NULL, run_id INTEGER NOT NULL, PRIMARY KEY (flag, run_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS runs_cp ON runs (cp, started);
+CREATE INDEX IF NOT EXISTS runs_atom ON runs (atom, started);
+CREATE INDEX IF NOT EXISTS runs_exit_code ON runs (exit_code, started);
+CREATE INDEX IF NOT EXISTS runs_started ON runs (started);
+"""
+
+
+class ResultsStore:
+    """
+    Persistent SQLite store of test results, keyed on cpv, USE flags, FEATURES=test toggle
+    and get_inputs_key() of the package when it was tested.
+
+    Every run is also kept with its report entry in the runs table, see query_runs().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "cpv TEXT NOT NULL, use_flags TEXT NOT NULL, test_feature_toggle INTEGER NOT NULL, "
+            "inputs TEXT NOT NULL, exit_code INTEGER NOT NULL, timestamp REAL NOT NULL, "
+            "PRIMARY KEY (cpv, use_flags, test_feature_toggle, inputs))"
+        )
+        self.connection.executescript(RUNS_SCHEMA)
+        self.connection.commit()
+
+    def add_run(self, entry):
+        """
+        Add a report entry to the runs table, unless it is there already.
+        Not committed.
+
+        :return: whether it was added, never for entries of skipped jobs
+        """
+        if "skipped" in entry:
+            return False
+
+        use_flags = normalize_use_flags(entry["use_flags"])
+        started = 0
+        if entry.get("time"):
+            started = datetime.datetime.fromisoformat(
+                entry["time"]["started"]
+            ).timestamp()
+        try:
+            duration = get_report_duration(entry)
+        except (KeyError, ValueError):
+            duration = None
+
+        cursor = self.connection.execute(
+            "INSERT OR IGNORE INTO runs "
+            "(atom, cp, use_flags, test_feature_toggle, exit_code, started, duration, entry) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                entry["atom"],
+                get_report_cp(entry),
+                use_flags,
+                int(entry["test_feature_toggle"]),
+                entry["exit_code"],
+                started,
+                duration,
+                json.dumps(entry, sort_keys=True),
+            ),
+        )
+        if not cursor.rowcount:
+            return False
+
+        self.connection.executemany(
+            "INSERT INTO run_use_flags VALUES (?, ?)",
+            [(flag, cursor.lastrowid) for flag in use_flags.split()],
+        )
+        return True
+
+    def query_runs(
+        self, cp=None, atom=None, use_flags=(), failed=None, since=None, limit=None
+    ):
+        """
+        Report entries of the runs matching all the given conditions, latest first.
+
+        :param use_flags: flags the runs had set like this, as 'flag' or '-flag'
+        :param failed: True for failed runs only, False for passed runs only
+        :param since: timestamp of the earliest run
+        """
+        conditions = []
+        parameters = []
+
+        if cp is not None:
+            conditions.append("cp = ?")
+            parameters.append(cp)
+        if atom is not None:
+            conditions.append("atom = ?")
+            parameters.append(atom)
+        for flag in use_flags:
+            conditions.append("id IN (SELECT run_id FROM run_use_flags WHERE flag = ?)")
+            parameters.append(flag)
+        if failed is not None:
+            conditions.append("exit_code != 0" if failed else "exit_code = 0")
+        if since is not None:
+            conditions.append("started >= ?")
+            parameters.append(since)
+
+        query = "SELECT entry FROM runs"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY started DESC, id DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            parameters.append(limit)
+
+        return [
+            json.loads(entry) for (entry,) in self.connection.execute(query, parameters)
+        ]
+
+    def record(self, result):
+        """
+        Store a result as returned by run_testing(), as a run and, unless its inputs
+        are unknown, as the last result of its combination.
+        """
+        self.add_run(result)
+
+        if result.get("inputs") is not None and "skipped" not in result:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    result["cpv"],
+                    normalize_use_flags(result["use_flags"]),
+                    int(result["test_feature_toggle"]),
+                    result["inputs"],
+                    result["exit_code"],
+                    time.time(),
+                ),
+            )
+        self.connection.commit()
+
+    def get_results(self, cpv, inputs, before=None):
+        """
+        Get the last exit codes of cpv tested with the same inputs.
+
+        :param before: only consider results stored before this timestamp
+        :return: dict of exit codes keyed on (normalized USE flags, FEATURES=test toggle)
+        """
+        if inputs is None:
+            return {}
+
+        rows = self.connection.execute(
+            "SELECT use_flags, test_feature_toggle, exit_code FROM results "
+            "WHERE cpv = ? AND inputs = ? AND timestamp < ?",
+            (cpv, inputs, float("inf") if before is None else before),
+        )
+
+        return {
+            (use_flags, bool(test_feature_toggle)): exit_code
+            for use_flags, test_feature_toggle, exit_code in rows
+        }
+
+    def close(self):
+        self.connection.close()
+
+
+def get_results_store(cache_dir):
+    """
+    Open the results store in cache_dir, or return None if that is not possible.
+    """
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        return ResultsStore(os.path.join(cache_dir, "results.sqlite"))
+    except (OSError, sqlite3.Error) as e:
+        logging.warning(
+            "Could not open results store in {}, continuing without: {}".format(
+                cache_dir, e
+            )
+        )
+        return None
+
+
+def get_metadata_cache(cache_dir):
+    """
+    Open the metadata cache in cache_dir, or return None if that is not possible.
+    """
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        return MetadataCache(os.path.join(cache_dir, "metadata.sqlite"))
+    except (OSError, sqlite3.Error) as e:
+        logging.warning(
+            "Could not open metadata cache in {}, continuing without: {}".format(
+                cache_dir, e
+            )
+        )
+        return None
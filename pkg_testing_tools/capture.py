@@ -0,0 +1,293 @@
+import collections
+import logging
+import os
+import re
+import tempfile
+import time
+
+# Default amount of output kept in memory per command, in bytes.
+DEFAULT_TAIL_SIZE = 1024 * 1024
+
+# Lines that start the interesting part of a failed build: portage's die() message,
+# compiler errors, make and ninja failures.
+ERROR_RE = re.compile(
+    rb"(^ \* ERROR: |: (fatal )?error: |^make(\[\d+\])?: \*\*\* |^FAILED: )"
+)
+
+ERROR_CONTEXT_BEFORE = 20
+ERROR_CONTEXT_AFTER = 40
+
+
+class OutputCapture:
+    """
+    Bounded capture of command output: the last tail_size bytes are kept in memory,
+    together with the section around the first error, and everything is written
+    to an optional spill file.
+
+    >>> capture = OutputCapture(tail_size=10)
+    >>> for line in [b"1234\\n", b"x.c:1:2: error: oops\\n", b"5678\\n", b"90\\n"]:
+    ...     capture.feed(line)
+    >>> capture.get_tail()
+    '5678\\n90\\n'
+    >>> print(capture.get_error_section())
+    1234
+    x.c:1:2: error: oops
+    5678
+    90
+    <BLANKLINE>
+    """
+
+    def __init__(self, spill=None, tail_size=DEFAULT_TAIL_SIZE):
+        self.spill = spill
+        self.tail_size = tail_size
+        self.tail = collections.deque()
+        self.tail_bytes = 0
+        self.before = collections.deque(maxlen=ERROR_CONTEXT_BEFORE)
+        self.error_section = None
+        self.error_lines_left = 0
+
+    def feed(self, line):
+        """
+        Capture a line of output, as bytes.
+        """
+        if self.spill is not None:
+            self.spill.write(line)
+
+        if self.error_section is None and ERROR_RE.search(line):
+            self.error_section = list(self.before)
+            self.error_lines_left = ERROR_CONTEXT_AFTER + 1
+
+        if self.error_lines_left > 0:
+            self.error_section.append(line)
+            self.error_lines_left -= 1
+        else:
+            self.before.append(line)
+
+        self.tail.append(line)
+        self.tail_bytes += len(line)
+        while self.tail_bytes > self.tail_size and len(self.tail) > 1:
+            self.tail_bytes -= len(self.tail.popleft())
+
+    def get_tail(self):
+        return b"".join(self.tail).decode(errors="replace")
+
+    def get_error_section(self):
+        """
+        Output around the first error, or None if no error was detected.
+        """
+        if self.error_section is None:
+            return None
+        return b"".join(self.error_section).decode(errors="replace")
+
+
+def open_spill_file(log_path=None):
+    """
+    Open the file all output of a command is written to: log_path, or a temporary file
+    that the caller removes if it is not needed.
+    """
+    if log_path is not None:
+        os.makedirs(os.path.dirname(log_path) or ".", exist_ok=True)
+        return open(log_path, "wb")
+
+    return tempfile.NamedTemporaryFile(
+        prefix="pkg-testing-tool-", suffix=".log", delete=False
+    )
+
+
+def log_captured_failure(result, capture, spill_path):
+    """
+    Log the error section and the tail of the output of a failed command.
+    """
+    logging.error("Command failed with exit code %d", result.returncode)
+
+    tail = capture.get_tail()
+    error_section = capture.get_error_section()
+    if error_section and error_section not in tail:
+        logging.error("First error: %s", error_section)
+
+    if tail:
+        logging.error("Last output: %s", tail)
+
+    if spill_path is not None:
+        logging.error("Full output: %s", spill_path)
+
+
+ANSI_ESCAPE_RE = re.compile(rb"\x1b\[[0-9;]*[A-Za-z]")
+
+# Lines of emerge output that start or end the build of a package.
+PACKAGE_LINE_RE = re.compile(
+    rb"^>>> (Emerging|Emerging binary|Installing|Completed) \(\d+ of \d+\) (\S+)"
+)
+FAILED_LINE_RE = re.compile(rb"^>>> Failed to (emerge|install) ")
+# First line of portage's message when an ebuild phase failed.
+FATAL_ERROR_RE = re.compile(rb"^ \* ERROR: (\S+) failed \((\w+) phase\)")
+# Lines of that message printed before the command is stopped, at most.
+FATAL_ERROR_MESSAGE_LINES = 40
+
+# Messages of ebuild phases of the package that is being built.
+PHASE_LINES = [
+    (b">>> Downloading ", "fetch"),
+    (b">>> Unpacking source", "unpack"),
+    (b">>> Preparing source", "prepare"),
+    (b">>> Configuring source", "configure"),
+    (b">>> Compiling source", "compile"),
+    (b">>> Test phase", "test"),
+    (b">>> Install ", "install"),
+]
+
+
+class PhaseTimer:
+    """
+    Time dependency resolution and the phases of every package built by emerge, from its output.
+
+    Phases of a package are only seen when emerge prints the build output, i.e. without
+    --quiet-build and with a single emerge job, otherwise the time between starting a
+    package and installing it is reported as 'build'.
+
+    >>> clock = iter(range(0, 100, 10))
+    >>> timer = PhaseTimer(lambda: next(clock))
+    >>> for line in [b"Calculating dependencies... done!", b">>> Emerging (1 of 1) a/b-1::gentoo",
+    ...              b">>> Compiling source in /var/tmp/portage/a/b-1/work ...", b">>> Test phase: a/b-1",
+    ...              b">>> Installing (1 of 1) a/b-1::gentoo", b">>> Completed (1 of 1) a/b-1::gentoo"]:
+    ...     timer.feed(line + b"\\n")
+    >>> timer.get_timings()
+    {'resolve': 10, 'packages': {'a/b-1': {'build': 10, 'compile': 10, 'test': 10, 'merge': 10}}}
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.started = clock()
+        self.resolve = None
+        self.packages = {}
+        # Packages that are being built, to their current phase and when it started.
+        self.current = {}
+        self.last_package = None
+
+    def switch(self, package, phase, now):
+        if package in self.current:
+            previous, started = self.current.pop(package)
+            phases = self.packages.setdefault(package, {})
+            phases[previous] = phases.get(previous, 0) + now - started
+        if phase is not None:
+            self.current[package] = (phase, now)
+
+    def feed(self, line):
+        line = ANSI_ESCAPE_RE.sub(b"", line).strip()
+
+        if not line.startswith(b">>> "):
+            return
+
+        now = self.clock()
+
+        if self.resolve is None:
+            self.resolve = now - self.started
+
+        match = PACKAGE_LINE_RE.match(line)
+        if match:
+            what, package = match.groups()
+            package = package.split(b"::")[0].decode(errors="replace")
+            phase = {
+                b"Emerging": "build",
+                b"Emerging binary": "binary",
+                b"Installing": "merge",
+                b"Completed": None,
+            }[what]
+            self.switch(package, phase, now)
+            self.last_package = package if phase in ("build", "binary") else None
+            return
+
+        if FAILED_LINE_RE.match(line):
+            for package in list(self.current):
+                self.switch(package, None, now)
+            return
+
+        if self.last_package in self.current:
+            for prefix, phase in PHASE_LINES:
+                if line.startswith(prefix):
+                    if self.current[self.last_package][0] != phase:
+                        self.switch(self.last_package, phase, now)
+                    return
+
+    def get_timings(self):
+        """
+        :return: dict with the seconds spent resolving dependencies and, per package, per phase
+        """
+        now = self.clock()
+        for package in list(self.current):
+            self.switch(package, None, now)
+
+        return {
+            "resolve": now - self.started if self.resolve is None else self.resolve,
+            "packages": self.packages,
+        }
+
+
+class MergeCounter:
+    """
+    Packages emerge installs from binary packages and builds from source, from its output.
+
+    >>> counter = MergeCounter()
+    >>> for line in [b">>> Emerging binary (1 of 2) a/b-1::gentoo", b">>> Emerging (2 of 2) a/c-2::gentoo"]:
+    ...     counter.feed(line + b"\\n")
+    >>> counter.binary, counter.source
+    (['a/b-1'], ['a/c-2'])
+    """
+
+    def __init__(self):
+        self.binary = []
+        self.source = []
+
+    def feed(self, line):
+        match = PACKAGE_LINE_RE.match(ANSI_ESCAPE_RE.sub(b"", line).strip())
+        if not match:
+            return
+
+        what, package = match.groups()
+        package = package.split(b"::")[0].decode(errors="replace")
+        if what == b"Emerging binary":
+            self.binary.append(package)
+        elif what == b"Emerging":
+            self.source.append(package)
+
+
+class FatalErrorWatcher:
+    """
+    Stops a command once an ebuild phase failed: at the first line after portage's
+    error message (the ' * ' lines that follow ' * ERROR: ... failed'), instead of
+    waiting for emerge to finish the other packages it builds.
+
+    >>> watcher = FatalErrorWatcher()
+    >>> for line in [b" * ERROR: a/b-1::gentoo failed (compile phase):", b" *   emake failed", b">>> Failed to emerge a/b-1"]:
+    ...     watcher.feed(line + b"\\n")
+    Traceback (most recent call last):
+    ...
+    pkg_testing_tools.supervisor.StopCommand
+    >>> watcher.package, watcher.phase
+    ('a/b-1::gentoo', 'compile')
+    """
+
+    def __init__(self):
+        self.package = None
+        self.phase = None
+        self.message_lines = 0
+
+    def feed(self, line):
+        line = ANSI_ESCAPE_RE.sub(b"", line).rstrip(b"\n")
+
+        if self.package is None:
+            match = FATAL_ERROR_RE.match(line)
+            if match:
+                self.package, self.phase = (
+                    group.decode(errors="replace") for group in match.groups()
+                )
+            return
+
+        self.message_lines += 1
+        if (
+            not line.startswith(b" *")
+            or self.message_lines >= FATAL_ERROR_MESSAGE_LINES
+        ):
+            # Imported here, main imports this module for DEFAULT_TAIL_SIZE before asyncio is needed.
+            from .supervisor import StopCommand
+
+            raise StopCommand()
@@ -0,0 +1,187 @@
+"""
+Finding the USE flags that make a combination fail.
+
+A failing USE flag combination is compared with the closest passing combination of
+the same package tested in the session, and the flags they differ in are narrowed
+down by delta debugging (ddmin): combinations in between are built until the smallest
+set of flag changes that still turns the passing combination into a failing one is
+found, usually in a logarithmic number of builds.
+"""
+
+import logging
+
+from .job import get_job_key
+from .report import get_result_key
+from .solver import get_required_use_solver
+from .use import parse_use_flags, render_use_flags
+
+
+class OutOfBuilds(Exception):
+    """
+    Raised by the test of ddmin() once it may not build any more combinations.
+    """
+
+
+def split(changes, n):
+    """
+    Split changes into n parts of nearly equal size.
+
+    >>> split([1, 2, 3, 4, 5], 2)
+    [[1, 2], [3, 4, 5]]
+    """
+    parts = []
+    start = 0
+    for i in range(n):
+        end = start + (len(changes) - start) // (n - i)
+        parts.append(changes[start:end])
+        start = end
+    return parts
+
+
+def ddmin(changes, test):
+    """
+    Minimize the changes that make test fail, after Zeller's ddmin.
+
+    :param changes: list of changes, for which test(changes) fails
+    :param test: called with a subset of changes, returns True if it fails, False if
+        it passes and None if it could not be tested, raises OutOfBuilds to give up;
+        results are not cached here
+    :return: minimized changes, whether they are 1-minimal (test did not give up)
+
+    >>> ddmin(list(range(8)), lambda changes: {2, 5} <= set(changes))
+    ([2, 5], True)
+    >>> builds = []
+    >>> def test(changes):
+    ...     if len(builds) == 2:
+    ...         raise OutOfBuilds()
+    ...     builds.append(changes)
+    ...     return 3 in changes
+    >>> ddmin(list(range(8)), test)
+    ([0, 1, 2, 3], False)
+    """
+    n = 2
+
+    while len(changes) >= 2:
+        parts = split(changes, n)
+        complements = [
+            [change for change in changes if change not in part] for part in parts
+        ]
+        # Try each part on its own, then everything but each part.
+        for candidate in parts + (complements if n > 2 else []):
+            try:
+                failed = test(candidate)
+            except OutOfBuilds:
+                return changes, False
+            if failed:
+                n = 2 if candidate in parts else max(n - 1, 2)
+                changes = candidate
+                break
+        else:
+            if n >= len(changes):
+                break
+            n = min(len(changes), 2 * n)
+
+    return changes, True
+
+
+def get_closest_passing(failing_mask, passing_masks):
+    """
+    Passing combination that differs from the failing one in the fewest flags.
+
+    >>> get_closest_passing(0b1011, [0b0000, 0b1001, 0b0111])
+    9
+    """
+    return min(
+        passing_masks, key=lambda mask: (bin(mask ^ failing_mask).count("1"), mask)
+    )
+
+
+def find_culprits(failing, results, metadata, args, run):
+    """
+    Find the USE flags that make the failing result fail, building the combinations
+    in between it and the closest passing result of the same atom.
+
+    :param failing: result of the failing job
+    :param results: results of the session, also used to not build a combination twice
+    :param metadata: package metadata as returned by get_package_metadata()
+    :param args: parsed command line arguments, args.bisect_failures limits the builds,
+        combinations ruled out by REQUIRED_USE or built before are not counted
+    :param run: called with a job, returns its result or None if it was not run
+    :return: culprit flags as set in the failing combination and whether they are minimal,
+        or None if there is no passing combination to compare with
+    """
+    iuse = metadata["iuse"]
+    solver = get_required_use_solver(iuse, metadata["ruse"])
+    known = {
+        get_result_key(result): result["exit_code"]
+        for result in results
+        if "skipped" not in result
+    }
+
+    passing_masks = [
+        parse_use_flags(iuse, result["use_flags"])
+        for result in results
+        if result["atom"] == failing["atom"]
+        and result["test_feature_toggle"] == failing["test_feature_toggle"]
+        and result["use_flags"]
+        and result["exit_code"] == 0
+    ]
+    if not passing_masks:
+        return None
+
+    failing_mask = parse_use_flags(iuse, failing["use_flags"])
+    passing_mask = get_closest_passing(failing_mask, passing_masks)
+    changes = [
+        position
+        for position in range(len(iuse))
+        if (failing_mask ^ passing_mask) >> position & 1
+    ]
+
+    builds = 0
+
+    def test(subset):
+        nonlocal builds
+        mask = passing_mask
+        for position in subset:
+            mask ^= 1 << position
+        if mask not in solver:
+            return None
+
+        job = {
+            "cpv": failing["atom"],
+            "cp": failing["cp"],
+            "resolved_cpv": failing["cpv"],
+            "iuse": iuse,
+            "inputs": failing["inputs"],
+            "extra_env_files": (
+                " ".join(args.extra_env_file) if args.extra_env_file else []
+            ),
+            "test_feature_toggle": failing["test_feature_toggle"],
+            "use_mask": mask,
+            "use_flags_scope": args.use_flags_scope,
+        }
+        key = get_job_key(job)
+        if key not in known:
+            if builds == args.bisect_failures:
+                raise OutOfBuilds()
+            builds += 1
+            result = run(job)
+            if result is None:
+                return None
+            known[key] = result["exit_code"]
+        return known[key] != 0
+
+    logging.info(
+        "Looking for the flags that make {} fail with USE: {}, compared to USE: {}".format(
+            failing["atom"],
+            failing["use_flags"],
+            " ".join(render_use_flags(iuse, passing_mask)),
+        )
+    )
+    culprits, minimal = ddmin(changes, test)
+
+    flags = [
+        iuse[position] if failing_mask >> position & 1 else "-" + iuse[position]
+        for position in culprits
+    ]
+    return flags, minimal
@@ -0,0 +1,518 @@
+"""
+Running the jobs of a session on several machines.
+
+The coordinator (--coordinator) defines the jobs as usual and hands them out over
+HTTP to workers ('pkg-testing-tool worker URL'), which run one job at a time and send
+the result back. Workers pull the next job whenever they are done, so faster workers
+run more jobs. A worker holds a lease on its job, renewed by heartbeats while the job
+runs; jobs of workers that stop sending heartbeats are handed out again, and the first
+result of a job wins.
+
+There is no authentication, the coordinator should only listen on trusted networks.
+"""
+
+import collections
+import json
+import logging
+import os
+import queue
+import socket
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from contextlib import ExitStack
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .binpkgs import get_binpkg_cache
+from .scheduler import JobQueue, describe_job, estimate_job_cost, load_history, run_job
+from .snapshot import VdbSnapshot
+from .supervisor import CommandCancelled, get_supervisor
+from .test import JobConfig
+from .tmp import get_etc_portage_tmp_file, get_portage_configroot
+
+# Seconds after the last heartbeat after which a job is handed out again.
+LEASE_TIMEOUT = 60
+HEARTBEAT_INTERVAL = 15
+# Seconds a worker waits before asking again while all jobs left are leased.
+POLL_INTERVAL = 5
+# Attempts of a worker to reach the coordinator before giving up.
+REQUEST_ATTEMPTS = 3
+
+# Options of the coordinator that change how jobs are run, applied on the workers.
+SESSION_OPTIONS = [
+    "append_emerge",
+    "binpkg",
+    "ccache",
+    "depclean",
+    "fail_fast",
+    "idle_timeout",
+    "oneshot",
+    "pretend",
+    "prune_failing",
+    "slow",
+    "tail_size",
+    "test_feature_scope",
+    "timeout",
+    "unmerge",
+]
+
+
+def parse_address(address):
+    """
+    >>> parse_address("0.0.0.0:8080"), parse_address(":8080")
+    (('0.0.0.0', 8080), ('', 8080))
+    """
+    host, _, port = address.rpartition(":")
+    return host, int(port)
+
+
+class Coordinator:
+    """
+    Jobs of a session and their leases, shared by the threads handling requests.
+
+    :param jobs: jobs as defined by define_jobs(), as a list (handed out longest first,
+        see estimate_job_cost()) or any iterable (consumed lazily, in order)
+    :param prune: skip or postpone jobs of failed packages, see JobQueue
+    """
+
+    def __init__(self, jobs, history=(), fail_fast=False, prune=False):
+        self.lock = threading.Lock()
+        self.fail_fast = fail_fast
+        self.max_i = len(jobs) if isinstance(jobs, list) else None
+        if self.max_i is None:
+            order = enumerate(jobs)
+        else:
+            costs = [estimate_job_cost(job, history) for job in jobs]
+            order = (
+                (i, jobs[i]) for i in sorted(range(len(jobs)), key=lambda i: -costs[i])
+            )
+        self.queue = JobQueue(order, prune, self.skip)
+        self.exhausted = False
+        self.stopped = False
+        # Workers that asked for jobs, and those that were told there are no more.
+        self.workers = set()
+        self.dismissed = set()
+        # Jobs handed out again after their worker was lost, as (i, job).
+        self.requeued = collections.deque()
+        # i: [job, worker, deadline]
+        self.leases = {}
+        self.results = {}
+        # Results in the order they arrived, for the main thread.
+        self.finished = queue.Queue()
+
+    def lease(self, worker):
+        """
+        :return: response to a worker asking for a job
+        """
+        with self.lock:
+            self.workers.add(worker)
+            if self.stopped:
+                self.dismissed.add(worker)
+                return {"done": True}
+
+            if self.requeued:
+                i, job = self.requeued.popleft()
+            else:
+                try:
+                    i, job = next(self.queue)
+                except StopIteration:
+                    self.exhausted = True
+                    if self.leases or self.requeued:
+                        return {"wait": POLL_INTERVAL}
+                    self.dismissed.add(worker)
+                    return {"done": True}
+
+            self.leases[i] = [job, worker, time.monotonic() + LEASE_TIMEOUT]
+
+        logging.info(
+            "Handing ({i} of {max_i}) {job} to {worker}".format(
+                i=i + 1,
+                max_i="?" if self.max_i is None else self.max_i,
+                job=describe_job(job),
+                worker=worker,
+            )
+        )
+        return {"id": i, "count": self.max_i, "job": job}
+
+    def skip(self, i, result):
+        # Called by the queue, with the lock held.
+        self.results[i] = result
+        self.finished.put((i, result))
+
+    def heartbeat(self, i, worker):
+        """
+        Renew the lease of a worker on job i.
+
+        :return: response telling the worker whether to cancel the job
+        """
+        with self.lock:
+            if self.stopped:
+                self.leases.pop(i, None)
+                return {"cancel": True}
+            if i in self.results:
+                return {"cancel": True}
+
+            if i not in self.leases:
+                # The job was requeued, but nobody took it yet: give it back.
+                for entry in self.requeued:
+                    if entry[0] == i:
+                        self.requeued.remove(entry)
+                        self.leases[i] = [entry[1], worker, None]
+                        break
+                else:
+                    return {"cancel": True}
+
+            lease = self.leases[i]
+            if lease[1] != worker:
+                return {"cancel": True}
+            lease[2] = time.monotonic() + LEASE_TIMEOUT
+            return {"cancel": False}
+
+    def complete(self, i, worker, result):
+        """
+        Record the result of job i, unless another worker already sent one.
+        """
+        with self.lock:
+            lease = self.leases.pop(i, None)
+            self.requeued = collections.deque(
+                entry for entry in self.requeued if entry[0] != i
+            )
+            if i in self.results:
+                logging.debug(
+                    "Ignoring another result of job {} from {}".format(i + 1, worker)
+                )
+                return
+
+            result["worker"] = worker
+            self.results[i] = result
+            if result["exit_code"] != 0:
+                if self.fail_fast:
+                    self.stopped = True
+                elif lease is not None:
+                    self.queue.record_failure(lease[0])
+
+        self.finished.put((i, result))
+
+    def expire_leases(self):
+        """
+        Hand out again the jobs of workers that stopped sending heartbeats.
+        """
+        now = time.monotonic()
+        with self.lock:
+            for i, (job, worker, deadline) in list(self.leases.items()):
+                if deadline < now:
+                    logging.warning(
+                        "Lost {worker}, handing out {job} again.".format(
+                            worker=worker, job=describe_job(job)
+                        )
+                    )
+                    del self.leases[i]
+                    self.requeued.appendleft((i, job))
+                    self.dismissed.add(worker)
+
+    def is_done(self):
+        with self.lock:
+            # After --fail-fast, until running jobs are cancelled or their workers lost.
+            if self.stopped:
+                return not self.leases
+            if self.leases or self.requeued:
+                return False
+            return self.exhausted or len(self.results) == self.max_i
+
+    def all_dismissed(self):
+        with self.lock:
+            return self.workers <= self.dismissed
+
+
+def get_request_handler(coordinator, session):
+    class RequestHandler(BaseHTTPRequestHandler):
+        def send_json(self, response):
+            body = json.dumps(response).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/session":
+                self.send_json(session)
+            else:
+                self.send_error(404)
+
+        def do_POST(self):
+            try:
+                request = json.loads(
+                    self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                )
+                worker = request["worker"]
+                if self.path == "/lease":
+                    response = coordinator.lease(worker)
+                elif self.path == "/heartbeat":
+                    response = coordinator.heartbeat(request["id"], worker)
+                elif self.path == "/result":
+                    coordinator.complete(request["id"], worker, request["result"])
+                    response = {}
+                else:
+                    self.send_error(404)
+                    return
+            except (ValueError, KeyError, TypeError) as e:
+                self.send_error(400, str(e))
+                return
+            self.send_json(response)
+
+        def log_message(self, format, *args):
+            logging.debug("{}: {}".format(self.address_string(), format % args))
+
+    return RequestHandler
+
+
+def serve_jobs(jobs, args, on_result=None, repos_conf=""):
+    """
+    Hand out jobs to workers from args.coordinator, until all of them finished.
+    Takes the place of run_jobs().
+
+    :param jobs: jobs as defined by define_jobs(), as a list or any iterable
+    :param args: parsed command line arguments
+    :param on_result: called with every result as soon as its job finished
+    :param repos_conf: repos.conf entries of the session, for the repositories of --file
+    :return: results of the jobs that were run, in the order the jobs were defined
+    """
+    coordinator = Coordinator(
+        jobs, load_history(args.history), args.fail_fast, args.prune_failing
+    )
+    session = {
+        "options": {name: getattr(args, name) for name in SESSION_OPTIONS},
+        "repos_conf": repos_conf,
+    }
+
+    server = ThreadingHTTPServer(
+        parse_address(args.coordinator), get_request_handler(coordinator, session)
+    )
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    logging.info(
+        "Waiting for workers on http://{}:{}/, start them with 'pkg-testing-tool worker URL'.".format(
+            *server.server_address[:2]
+        )
+    )
+
+    try:
+        while True:
+            try:
+                i, result = coordinator.finished.get(timeout=1)
+            except queue.Empty:
+                coordinator.expire_leases()
+                if coordinator.is_done() and coordinator.finished.empty():
+                    break
+                continue
+
+            if on_result is not None:
+                on_result(result)
+            if "skipped" in result:
+                continue
+            logging.info(
+                "Finished ({i} of {max_i}) {atom} on {worker}, exit code: {exit_code}".format(
+                    i=i + 1,
+                    max_i="?" if coordinator.max_i is None else coordinator.max_i,
+                    atom=result["atom"],
+                    worker=result["worker"],
+                    exit_code=result["exit_code"],
+                )
+            )
+            if coordinator.stopped:
+                logging.error(
+                    "Exiting due to --fail-fast, once running jobs are cancelled."
+                )
+
+        # Workers waiting for jobs ask again within POLL_INTERVAL, tell them to exit.
+        deadline = time.monotonic() + 2 * POLL_INTERVAL
+        while not coordinator.all_dismissed() and time.monotonic() < deadline:
+            time.sleep(0.1)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    return [coordinator.results[i] for i in sorted(coordinator.results)]
+
+
+def request(url, path, data=None):
+    """
+    Send a request to the coordinator, a POST of data as JSON if given.
+
+    :return: decoded JSON response
+    :raises urllib.error.URLError: if the coordinator could not be reached
+    """
+    body = None if data is None else json.dumps(data).encode()
+    for attempt in range(1, REQUEST_ATTEMPTS + 1):
+        try:
+            with urllib.request.urlopen(
+                urllib.request.Request(
+                    url.rstrip("/") + "/" + path,
+                    data=body,
+                    headers={"Content-Type": "application/json"},
+                ),
+                timeout=30,
+            ) as response:
+                return json.load(response)
+        except urllib.error.URLError:
+            if attempt == REQUEST_ATTEMPTS:
+                raise
+            time.sleep(POLL_INTERVAL)
+
+
+def send_heartbeats(url, worker, i, stop):
+    """
+    Renew the lease on job i until stop is set, cancelling the job when told so.
+    """
+    while not stop.wait(HEARTBEAT_INTERVAL):
+        try:
+            response = request(url, "heartbeat", {"worker": worker, "id": i})
+        except urllib.error.URLError as e:
+            logging.warning("Could not reach the coordinator: {}".format(e))
+            continue
+        if response.get("cancel"):
+            logging.warning("Coordinator cancelled the job.")
+            get_supervisor().cancel_all()
+            return
+
+
+def run_worker(args, cache_dir):
+    """
+    Run jobs from the coordinator at args.url, one at a time, until it has no more.
+
+    :param args: parsed command line arguments of 'pkg-testing-tool worker'
+    :param cache_dir: directory of the binary package cache, with args.binpkg_cache
+    """
+    worker = args.name or "{}:{}".format(socket.gethostname(), os.getpid())
+
+    try:
+        session = request(args.url, "session")
+    except urllib.error.URLError as e:
+        logging.critical(
+            "Could not reach the coordinator at {}: {}".format(args.url, e)
+        )
+        sys.exit(1)
+
+    for name, value in session["options"].items():
+        setattr(args, name, value)
+
+    if args.binpkg_cache:
+        args.binpkg = True
+
+    if args.snapshot and (args.unmerge or args.depclean):
+        logging.critical(
+            "--snapshot can not be combined with --unmerge or --depclean of the coordinator."
+        )
+        sys.exit(1)
+
+    with ExitStack() as stack:
+        tmp_files = {}
+        for directory in ["package.accept_keywords", "package.unmask", "repos.conf"]:
+            tmp_files[directory] = stack.enter_context(
+                get_etc_portage_tmp_file(directory, args.prefix)
+            )
+        tmp_files["repos.conf"].write(session["repos_conf"])
+        tmp_files["repos.conf"].flush()
+
+        # A PORTAGE_CONFIGROOT of its own, so that workers on the same host don't
+        # overwrite each other's package.use/package.env files.
+        config_root = stack.enter_context(get_portage_configroot(args.prefix))
+        job_config = stack.enter_context(JobConfig(config_root))
+
+        binpkg_cache = None
+        if args.binpkg_cache:
+            binpkg_cache = get_binpkg_cache(
+                cache_dir, int(args.binpkg_cache_size * 1024**3)
+            )
+            if binpkg_cache is not None:
+                binpkg_cache.evict()
+                stack.callback(binpkg_cache.evict)
+
+        snapshot = None
+        if args.snapshot:
+            snapshot = VdbSnapshot()
+            logging.info(
+                "Recorded {} installed packages to restore after every job.".format(
+                    len(snapshot.packages)
+                )
+            )
+        unmasked = set()
+        count = 0
+
+        while True:
+            try:
+                lease = request(args.url, "lease", {"worker": worker})
+            except urllib.error.URLError as e:
+                logging.error("Lost the coordinator, exiting: {}".format(e))
+                sys.exit(1)
+
+            if lease.get("done"):
+                break
+            if "wait" in lease:
+                time.sleep(lease["wait"])
+                continue
+
+            job = lease["job"]
+            if job["cpv"] not in unmasked:
+                unmasked.add(job["cpv"])
+                # Unconditionally unmask and keyword packages, like the coordinator does.
+                tmp_files["package.accept_keywords"].write(
+                    "{atom} **\n".format(atom=job["cpv"])
+                )
+                tmp_files["package.unmask"].write("{atom}\n".format(atom=job["cpv"]))
+                tmp_files["package.accept_keywords"].flush()
+                tmp_files["package.unmask"].flush()
+
+            stop = threading.Event()
+            heartbeats = threading.Thread(
+                target=send_heartbeats,
+                args=(args.url, worker, lease["id"], stop),
+                daemon=True,
+            )
+            heartbeats.start()
+            try:
+                result = run_job(
+                    job,
+                    args,
+                    lease["id"] + 1,
+                    lease["count"],
+                    job_config,
+                    config_root,
+                    binpkg_cache=binpkg_cache,
+                    snapshot=snapshot,
+                )
+            except CommandCancelled:
+                logging.warning("Cancelled {}".format(describe_job(job)))
+                result = None
+            finally:
+                stop.set()
+                heartbeats.join()
+
+            if result is None:
+                get_supervisor().reset()
+                continue
+
+            count += 1
+            try:
+                request(
+                    args.url,
+                    "result",
+                    {"worker": worker, "id": lease["id"], "result": result},
+                )
+            except urllib.error.URLError as e:
+                logging.error("Lost the coordinator, exiting: {}".format(e))
+                sys.exit(1)
+
+        if binpkg_cache is not None:
+            logging.info(
+                "Binary package cache: {} packages installed from it, {} built from source.".format(
+                    binpkg_cache.hits, binpkg_cache.misses
+                )
+            )
+
+    logging.info("Coordinator has no more jobs, ran {} of them.".format(count))
@@ -1,20 +1,62 @@
 import argparse
 import datetime
+import hashlib
 import json
 import logging
 import os
+import random
 import shlex
 import subprocess
 import sys
 from contextlib import ExitStack
 from tempfile import NamedTemporaryFile
 
-import portage
+from .cache import METADATA_KEYS, get_inputs_key
+from .portage_api import get_portage, get_portdb
+from .use import (
+    atom_to_cpv,
+    get_package_flags,
+    get_use_combination_indices,
+    parse_use_flags,
+    render_use_flags,
+)
 
-from .use import atom_to_cpv, get_package_flags, get_use_combinations
 
+def get_job_use_flags(job):
+    """
+    USE flags of a job as written to package.use, empty for the default flags.
 
-def get_package_metadata(atom):
+    >>> get_job_use_flags({"iuse": ["flag1", "flag2"], "use_mask": 1})
+    ['flag1', '-flag2']
+    """
+    return render_use_flags(job["iuse"], job["use_mask"])
+
+
+def get_job_key(job):
+    """
+    Key identifying a job across sessions: atom, USE flags and FEATURES=test toggle.
+
+    >>> get_job_key({"cpv": "=a/b-1", "iuse": ["x", "y"], "use_mask": 1, "test_feature_toggle": False})
+    ('=a/b-1', 'x -y', False)
+    """
+    return (job["cpv"], " ".join(get_job_use_flags(job)), job["test_feature_toggle"])
+
+
+def get_job_log_name(job):
+    """
+    Name of the file the output of a job is written to, unique per job key.
+
+    >>> get_job_log_name({"cpv": "=a/b-1", "cp": "a/b", "iuse": ["x"], "use_mask": 1, "test_feature_toggle": True})
+    'a_b-1-test-efb9ba60.log'
+    """
+    return "{pv}{test}-{key}.log".format(
+        pv=job["cpv"].lstrip("<>=~").split("::")[0].replace("/", "_"),
+        test="-test" if job["test_feature_toggle"] else "",
+        key=hashlib.sha1(repr(get_job_key(job)).encode()).hexdigest()[:8],
+    )
+
+
+def get_package_metadata(atom, metadata_cache=None):
     # This handles revisions properly, but not live ebuilds: https://bugs.gentoo.org/918693 https://github.com/APN-Pucky/pkg-testing-tools/issues/10
     cpv = atom_to_cpv(atom)
     # cpv is None on missing/masked packages
@@ -25,14 +67,19 @@ def get_package_metadata(atom):
             f"could not find unmasked package {atom}, assuming it is available"
         )
         # This handles live ebuilds properly, but not revisions: https://bugs.gentoo.org/918693 https://github.com/APN-Pucky/pkg-testing-tools/issues/10
-        cpv = portage.dep.dep_getcpv(atom)
+        cpv = get_portage().dep.dep_getcpv(atom)
         logging.debug(f"cpv through dep_getcpv(): {cpv}")
 
-    cp, version, revision = portage.versions.pkgsplit(cpv)
+    cp, version, revision = get_portage().versions.pkgsplit(cpv)
 
-    iuse, ruse = get_package_flags(cpv)
+    if metadata_cache is not None:
+        aux = metadata_cache.aux_get(cpv)
+    else:
+        aux = get_portdb().aux_get(cpv, METADATA_KEYS)
 
-    phases = portage.portdb.aux_get(cpv, ["DEFINED_PHASES"])[0].split()
+    iuse, ruse = get_package_flags(cpv, aux[:2])
+
+    phases = aux[2].split()
 
     return {
         "atom": atom,
@@ -46,14 +93,31 @@ def get_package_metadata(atom):
     }
 
 
-def define_jobs(atom, args):
+def define_jobs(atom, args, metadata_cache=None, results_store=None):
     jobs = []
 
-    package_metadata = get_package_metadata(atom)
+    package_metadata = get_package_metadata(atom, metadata_cache)
+
+    inputs = None
+    tested = []
+    if results_store is not None:
+        inputs = get_inputs_key(package_metadata["cpv"])
+        # Results stored later belong to this session, leave them out so a resumed session picks the same combinations.
+        tested = [
+            parse_use_flags(package_metadata["iuse"], use_flags)
+            for use_flags, _ in results_store.get_results(
+                package_metadata["cpv"], inputs, args.session_start
+            )
+            if use_flags
+        ]
 
     common = {
         "cpv": atom,
         "cp": package_metadata["cp"],
+        # The ebuild the atom resolved to, results are stored under it.
+        "resolved_cpv": package_metadata["cpv"],
+        "iuse": package_metadata["iuse"],
+        "inputs": inputs,
         "extra_env_files": (
             " ".join(args.extra_env_file) if args.extra_env_file else []
         ),
@@ -66,12 +130,16 @@ def define_jobs(atom, args):
         package_metadata["ruse"].append(args.append_required_use)
 
     if package_metadata["iuse"] and args.max_use_combinations != 0:
-        use_combinations = get_use_combinations(
+        use_combinations = get_use_combination_indices(
             package_metadata["iuse"],
             package_metadata["ruse"],
             args.max_use_combinations,
             args.add_sparse_use,
             args.add_dense_use,
+            # Seeded per atom, so the combinations only depend on the seed and the atom itself.
+            random.Random("{}:{}".format(args.seed, atom)),
+            args.use_strategy,
+            tested,
         )
         logging.debug("Use flags found for {}: {}".format(atom, use_combinations))
     else:
@@ -85,13 +153,13 @@ def define_jobs(atom, args):
             job.update(
                 {
                     "test_feature_toggle": True,
-                    "use_flags": [],
+                    "use_mask": None,
                     "use_flags_scope": args.use_flags_scope,
                 }
             )
             jobs.append(job)
 
-        for flags_set in use_combinations:
+        for use_mask in use_combinations:
             job = {}
             job.update(common)
             job.update(
@@ -101,7 +169,7 @@ def define_jobs(atom, args):
                         and args.test_feature_scope == "always"
                     )
                     or args.test_feature_scope == "force",
-                    "use_flags": flags_set,
+                    "use_mask": use_mask,
                     "use_flags_scope": args.use_flags_scope,
                 }
             )
@@ -113,7 +181,7 @@ def define_jobs(atom, args):
             job.update(
                 {
                     "test_feature_toggle": True,
-                    "use_flags": [],
+                    "use_mask": None,
                     "use_flags_scope": args.use_flags_scope,
                 }
             )
@@ -126,7 +194,7 @@ def define_jobs(atom, args):
                 {
                     # This is effectively false (except if force is set and package has no tests)
                     "test_feature_toggle": args.test_feature_scope == "force",
-                    "use_flags": [],
+                    "use_mask": None,
                     "use_flags_scope": args.use_flags_scope,
                 }
             )
@@ -135,17 +203,17 @@ def define_jobs(atom, args):
             if args.test_feature_scope != "first":
                 job = {}
                 job.update(common)
-                job.update({"test_feature_toggle": False, "use_flags": []})
+                job.update({"test_feature_toggle": False, "use_mask": None})
                 jobs.append(job)
 
             job = {}
             job.update(common)
-            job.update({"test_feature_toggle": True, "use_flags": []})
+            job.update({"test_feature_toggle": True, "use_mask": None})
             jobs.append(job)
 
             if args.test_feature_scope == "first":
                 job = {}
                 job.update(common)
-                job.update({"test_feature_toggle": False, "use_flags": []})
+                job.update({"test_feature_toggle": False, "use_mask": None})
                 jobs.append(job)
     return jobs
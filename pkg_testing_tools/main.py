@@ -1,17 +1,34 @@
 #!/usr/bin/env python3
 
 import argparse
-import json
+import functools
 import logging
 import os
+import random
 import subprocess
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import ExitStack
 
-from .job import define_jobs
-from .test import run_cmd, run_testing
+from .capture import DEFAULT_TAIL_SIZE
+from .report import (
+    JsonlWriter,
+    get_result_key,
+    get_summary,
+    load_journal,
+    open_journal,
+    parse_since,
+    write_json,
+    write_report,
+)
 from .tmp import get_etc_portage_tmp_file
 
+DEFAULT_CACHE_DIR = "/var/cache/pkg-testing-tools"
+
+# Manifests generated at the same time for --file, which mostly waits on fetching and hashing distfiles.
+MAX_MANIFEST_JOBS = 8
+
 
 def process_args(sysargs):
     parser = argparse.ArgumentParser()
@@ -35,6 +52,13 @@ def process_args(sysargs):
         help="Portage ebuild file like 'foo-1.2.3.ebuild'. Must reside in a repository.",
     )
 
+    group.add_argument(
+        "--batch",
+        action="store",
+        type=str,
+        help="File with a list of package atoms to test, one per line ('#' starts a comment), or '-' for stdin. Jobs of an atom are only defined once the jobs before them are started, so testing starts right away, and with --report, the report is rewritten after every job.",
+    )
+
     optional = parser.add_argument_group("Optional")
 
     optional.add_argument(
@@ -45,6 +69,14 @@ def process_args(sysargs):
         help="Explicit unmerge before each test install.",
     )
 
+    optional.add_argument(
+        "--snapshot",
+        action="store_true",
+        required=False,
+        default=False,
+        help="Record the installed packages before the first job (once --plan installed the shared dependencies) and, after every job, unmerge the packages it merged and merge again (from binary packages where available) those it replaced. Faster than --depclean, and also undoes upgrades and rebuilds. Can not be combined with --unmerge, --depclean or --parallel.",
+    )
+
     optional.add_argument(
         "--depclean",
         "-c",
@@ -58,7 +90,15 @@ def process_args(sysargs):
         "-ff",
         action="store_true",
         required=False,
-        help="Exit on first failure. Useful to inspect fail logs. Default: False.",
+        help="Exit on first failure, killing emerge as soon as a phase failed instead of letting it finish. Useful to inspect fail logs. Default: False.",
+    )
+
+    optional.add_argument(
+        "--prune-failing",
+        action="store_true",
+        required=False,
+        default=False,
+        help="Once a job failed, skip queued jobs of the same package (and FEATURES=test toggle) with the very same USE flags, reported as skipped, and run those that enable at least the same USE flags last. Kills emerge as soon as a phase failed, like --fail-fast. Default: False.",
     )
 
     optional.add_argument(
@@ -83,6 +123,23 @@ def process_args(sysargs):
         help="Append --usepkg to emerge command and add buildpkg to FEATURES.",
     )
 
+    optional.add_argument(
+        "--binpkg-cache",
+        action="store_true",
+        required=False,
+        default=False,
+        help="Implies --binpkg. Build and install binary packages of dependencies in a cache shared by all jobs and sessions (in --cache-dir), with a PKGDIR per CFLAGS/CHOST/profile and binary packages told apart by USE flags, instead of the system PKGDIR. Hits and misses are recorded in the report.",
+    )
+
+    optional.add_argument(
+        "--binpkg-cache-size",
+        action="store",
+        type=float,
+        required=False,
+        default=20,
+        help="Size in GiB the binary package cache is kept under, by removing the binary packages used least recently. Default: 20.",
+    )
+
     optional.add_argument(
         "--ccache", action="store_true", required=False, help="Add ccache to FEATURES."
     )
@@ -122,6 +179,17 @@ def process_args(sysargs):
         help="Generate up to N combinations of USE flags, the combinations are random out of those which pass check for REQUIRED_USE. Default: 16.",
     )
 
+    optional.add_argument(
+        "--use-strategy",
+        "-us",
+        action="store",
+        type=str,
+        required=False,
+        default="random",
+        choices=["random", "pairwise", "3wise"],
+        help="How to pick USE flag combinations: random, or a covering array in which every valid pair (pairwise) or triple (3wise) of flag states is built at least once with as few combinations as possible, capped by --max-use-combinations. Default: 'random'.",
+    )
+
     optional.add_argument(
         "--use-flags-scope",
         "-ufs",
@@ -153,6 +221,46 @@ def process_args(sysargs):
         help="Save report in JSON format under specified path.",
     )
 
+    optional.add_argument(
+        "--report-jsonl",
+        action="store",
+        type=str,
+        required=False,
+        help="Write the report in JSON Lines format under specified path as it goes, one report entry per line, written as soon as its job finished.",
+    )
+
+    optional.add_argument(
+        "--report-summary",
+        action="store",
+        type=str,
+        required=False,
+        help="Keep a JSON summary of the session (state, numbers of passed and failed jobs, failures) under specified path, replaced after every job.",
+    )
+
+    optional.add_argument(
+        "--journal",
+        action="store",
+        type=str,
+        required=False,
+        help="Append the result of every job to a JSON Lines checkpoint journal under specified path as soon as it finished.",
+    )
+
+    optional.add_argument(
+        "--resume",
+        action="store",
+        type=str,
+        required=False,
+        help="Resume the session recorded in a journal written by --journal: the same seed is used, jobs already in the journal are skipped and new results are appended to it. Pass the same atoms/files as before.",
+    )
+
+    optional.add_argument(
+        "--seed",
+        action="store",
+        type=int,
+        required=False,
+        help="Seed for picking random USE flag combinations. Default: random, printed at start.",
+    )
+
     optional.add_argument(
         "--slow",
         action="store_true",
@@ -161,6 +269,58 @@ def process_args(sysargs):
         default=False,
     )
 
+    optional.add_argument(
+        "--timeout",
+        action="store",
+        type=float,
+        required=False,
+        help="Kill the emerge of a job (and everything it started) after running for N minutes. Default: no limit.",
+    )
+
+    optional.add_argument(
+        "--idle-timeout",
+        action="store",
+        type=float,
+        required=False,
+        help="Kill the emerge of a job (and everything it started) after it printed nothing for N minutes, like a hung test suite. Default: no limit.",
+    )
+
+    optional.add_argument(
+        "--log-dir",
+        action="store",
+        type=str,
+        required=False,
+        help="With --quiet, write the whole output of every job to a file in specified directory. Without it, output is only kept in a temporary file if the job failed.",
+    )
+
+    optional.add_argument(
+        "--tail-size",
+        action="store",
+        type=float,
+        required=False,
+        default=DEFAULT_TAIL_SIZE / 1024 / 1024,
+        help="With --quiet, keep the last N MiB of output of every command in memory, to be printed if it failed (together with the section around the first error). Default: %(default)s.",
+    )
+
+    optional.add_argument(
+        "--coordinator",
+        action="store",
+        type=str,
+        required=False,
+        metavar="ADDRESS:PORT",
+        help="Instead of running jobs, hand them out over HTTP on ADDRESS:PORT to workers started with 'pkg-testing-tool worker http://ADDRESS:PORT/' on identically set up machines, and collect their results in one report. Jobs of workers that are lost are handed out again. There is no authentication, only listen on trusted networks. Can not be combined with --parallel or --snapshot.",
+    )
+
+    optional.add_argument(
+        "--bisect-failures",
+        action="store",
+        type=int,
+        required=False,
+        default=0,
+        metavar="MAX_BUILDS",
+        help="After all jobs ran, narrow down every failing USE flag combination to the flags that make it fail, by delta debugging against the closest passing combination of the same package: up to MAX_BUILDS combinations in between are built per failure. The culprit flags are recorded in the report. Default: 0 (off).",
+    )
+
     optional.add_argument(
         "--prefix",
         action="store",
@@ -170,6 +330,80 @@ def process_args(sysargs):
         help="Set the prefix for the portage configuration files. Default: ''.",
     )
 
+    optional.add_argument(
+        "--parallel",
+        "-P",
+        action="store",
+        type=int,
+        required=False,
+        default=1,
+        help="Run up to N jobs at the same time, each with its own temporary PORTAGE_CONFIGROOT mirroring /etc/portage. Can not be combined with --unmerge or --depclean. Default: 1.",
+    )
+
+    optional.add_argument(
+        "--plan",
+        action="store_true",
+        required=False,
+        help="Resolve the dependencies of all jobs up front with 'emerge --pretend', in parallel. Jobs are then run so that consecutive jobs share the most dependencies (with --parallel, jobs still start longest first), and with --binpkg, dependencies built from source by several jobs are built once as binary packages first.",
+    )
+
+    optional.add_argument(
+        "--cpu-budget",
+        action="store",
+        type=int,
+        required=False,
+        default=0,
+        help="CPUs shared by jobs running in parallel, through MAKEOPTS -j/-l. Default: number of CPUs.",
+    )
+
+    optional.add_argument(
+        "--memory-budget",
+        action="store",
+        type=float,
+        required=False,
+        default=0,
+        help="Memory in GiB shared by jobs running in parallel. Jobs are held back while the peak memory of their previous runs (see --history) does not fit. Default: unlimited.",
+    )
+
+    optional.add_argument(
+        "--history",
+        action="append",
+        type=str,
+        required=False,
+        help="JSON report of previous runs, used to start the most expensive jobs first when running in parallel. Can be passed multiple times.",
+    )
+
+    optional.add_argument(
+        "--cache-dir",
+        action="store",
+        type=str,
+        required=False,
+        default="",
+        help="Directory for persistent caches, like the ebuild metadata cache and the results store. Default: '{prefix}/var/cache/pkg-testing-tools'.",
+    )
+
+    optional.add_argument(
+        "--no-metadata-cache",
+        action="store_true",
+        required=False,
+        default=False,
+        help="Always query Portage for IUSE/REQUIRED_USE/DEFINED_PHASES instead of using the metadata cache.",
+    )
+
+    optional.add_argument(
+        "--skip-tested",
+        action="store_true",
+        required=False,
+        help="Skip jobs that passed before with the same USE flags, FEATURES=test toggle, ebuild, eclasses and portage configuration, as recorded in the results store under --cache-dir.",
+    )
+
+    optional.add_argument(
+        "--no-results-cache",
+        action="store_true",
+        required=False,
+        help="Neither read nor record results in the results store under --cache-dir. By default, USE flag combinations that were not tested before are preferred.",
+    )
+
     optional.add_argument(
         "--debug",
         action="store_true",
@@ -221,6 +455,42 @@ def process_args(sysargs):
             )
         extra_args.remove("--")
 
+    if args.parallel > 1 and (args.unmerge or args.depclean):
+        parser.error(
+            "--parallel can not be combined with --unmerge or --depclean, as those would remove packages used by other running jobs."
+        )
+
+    if args.snapshot and (args.unmerge or args.depclean or args.parallel > 1):
+        parser.error(
+            "--snapshot can not be combined with --unmerge, --depclean or --parallel, it restores the installed packages on its own after every job."
+        )
+
+    if args.coordinator and (args.parallel > 1 or args.snapshot or args.binpkg_cache):
+        parser.error(
+            "--coordinator runs no jobs itself: start several workers to run jobs in parallel, and pass --snapshot or --binpkg-cache to 'pkg-testing-tool worker' instead."
+        )
+
+    if args.bisect_failures and (args.fail_fast or args.coordinator):
+        parser.error(
+            "--bisect-failures runs more jobs after failures, it can not be combined with --fail-fast or --coordinator."
+        )
+
+    if args.batch and args.plan:
+        parser.error(
+            "--plan needs all jobs up front, it can not be combined with --batch."
+        )
+
+    if args.batch == "-" and args.ask:
+        parser.error(
+            "--ask reads the answer from stdin, which --batch - reads atoms from."
+        )
+
+    if args.binpkg_cache:
+        args.binpkg = True
+
+    if args.journal and args.resume and args.journal != args.resume:
+        parser.error("--resume already appends to the journal it resumes.")
+
     if len(sysargs) == 0:
         parser.print_help(sys.stderr)
         sys.exit(1)
@@ -233,6 +503,228 @@ def process_args(sysargs):
     return args, extra_args
 
 
+def process_worker_args(sysargs):
+    parser = argparse.ArgumentParser(
+        prog="pkg-testing-tool worker",
+        description="Run jobs handed out by 'pkg-testing-tool --coordinator', one at a time, until it has no more. How jobs are run (--binpkg, --timeout and the like) is taken from the coordinator. To run several jobs at a time on one host, start several workers.",
+    )
+
+    parser.add_argument(
+        "url",
+        help="URL of the coordinator, like 'http://builder1:8080/'.",
+    )
+
+    parser.add_argument(
+        "--name",
+        action="store",
+        type=str,
+        required=False,
+        help="Name of this worker in the report and the logs of the coordinator. Default: '{hostname}:{pid}'.",
+    )
+
+    parser.add_argument(
+        "--prefix",
+        action="store",
+        default="",
+        type=str,
+        required=False,
+        help="Set the prefix for the portage configuration files. Default: ''.",
+    )
+
+    parser.add_argument(
+        "--log-dir",
+        action="store",
+        type=str,
+        required=False,
+        help="With --quiet, write the whole output of every job to a file in specified directory.",
+    )
+
+    parser.add_argument(
+        "--snapshot",
+        action="store_true",
+        required=False,
+        default=False,
+        help="Record the installed packages before the first job and restore them after every job, like 'pkg-testing-tool --snapshot'. Only with one worker per system. Default: False.",
+    )
+
+    parser.add_argument(
+        "--binpkg-cache",
+        action="store_true",
+        required=False,
+        default=False,
+        help="Implies --binpkg. Build and install binary packages of dependencies in a cache shared by all jobs and sessions (in --cache-dir), like 'pkg-testing-tool --binpkg-cache'.",
+    )
+
+    parser.add_argument(
+        "--binpkg-cache-size",
+        action="store",
+        type=float,
+        required=False,
+        default=20,
+        help="Size in GiB the binary package cache is kept under, by removing the binary packages used least recently. Default: 20.",
+    )
+
+    parser.add_argument(
+        "--cache-dir",
+        action="store",
+        type=str,
+        required=False,
+        default="",
+        help="Directory of the binary package cache. Default: '{prefix}/var/cache/pkg-testing-tools'.",
+    )
+
+    parser.add_argument(
+        "--quiet",
+        action="store_true",
+        required=False,
+        help="Hide subprocess output unless there's an error. Default: False.",
+        default=False,
+    )
+
+    parser.add_argument(
+        "--debug",
+        action="store_true",
+        required=False,
+        help="Enable debug output, like printing emerge command line.",
+        default=False,
+    )
+
+    args = parser.parse_args(sysargs)
+
+    log_level = logging.DEBUG if args.debug else logging.INFO
+    logging.basicConfig(level=log_level, format="[%(levelname)s] >>> %(message)s")
+
+    return args
+
+
+def process_report_args(sysargs):
+    parser = argparse.ArgumentParser(
+        prog="pkg-testing-tool report",
+        description="Query the runs recorded in the results store, or import JSON reports, checkpoint journals and JSON Lines reports of earlier sessions into it.",
+    )
+
+    common = argparse.ArgumentParser(add_help=False)
+
+    common.add_argument(
+        "--cache-dir",
+        action="store",
+        type=str,
+        required=False,
+        help="Directory of the results store. Default: '{prefix}/var/cache/pkg-testing-tools'.",
+    )
+
+    common.add_argument(
+        "--prefix",
+        action="store",
+        default="",
+        type=str,
+        required=False,
+        help="Set the prefix for the portage configuration files. Default: ''.",
+    )
+
+    common.add_argument(
+        "--debug",
+        action="store_true",
+        required=False,
+        help="Enable debug output.",
+        default=False,
+    )
+
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    query = commands.add_parser(
+        "query",
+        parents=[common],
+        help="Print the runs matching all the given conditions, latest first.",
+    )
+
+    query.add_argument(
+        "--cp",
+        action="store",
+        type=str,
+        required=False,
+        help="Only runs of this category/package, like 'dev-libs/boost'.",
+    )
+
+    query.add_argument(
+        "--atom",
+        action="store",
+        type=str,
+        required=False,
+        help="Only runs of this atom, as in the report, like '=dev-libs/boost-1.84.0'.",
+    )
+
+    query.add_argument(
+        "--use",
+        action="append",
+        default=[],
+        type=str,
+        required=False,
+        help="Only runs with this USE flag enabled, or disabled with '-flag'. Can be passed multiple times.",
+    )
+
+    outcome = query.add_mutually_exclusive_group()
+
+    outcome.add_argument(
+        "--failed",
+        action="store_const",
+        const=True,
+        dest="failed",
+        help="Only failed runs.",
+    )
+
+    outcome.add_argument(
+        "--passed",
+        action="store_const",
+        const=False,
+        dest="failed",
+        help="Only passed runs.",
+    )
+
+    query.add_argument(
+        "--since",
+        action="store",
+        type=parse_since,
+        required=False,
+        help="Only runs started since then, given as an age like '30d', '12h' or '90m', or as an ISO date.",
+    )
+
+    query.add_argument(
+        "--limit",
+        action="store",
+        type=int,
+        required=False,
+        help="Print at most this many runs.",
+    )
+
+    query.add_argument(
+        "--json",
+        action="store_true",
+        required=False,
+        help="Print the report entries of the runs as JSON.",
+        default=False,
+    )
+
+    import_ = commands.add_parser(
+        "import",
+        parents=[common],
+        help="Add the runs of reports to the results store, skipping those already there.",
+    )
+
+    import_.add_argument(
+        "files",
+        nargs="+",
+        help="JSON reports (--report), checkpoint journals (--journal) or JSON Lines reports (--report-jsonl).",
+    )
+
+    args = parser.parse_args(sysargs)
+
+    log_level = logging.DEBUG if args.debug else logging.INFO
+    logging.basicConfig(level=log_level, format="[%(levelname)s] >>> %(message)s")
+
+    return args
+
+
 def yes_no(question):
     reply = input(question).lower()
 
@@ -242,8 +734,109 @@ def yes_no(question):
     return False
 
 
+@functools.lru_cache(maxsize=None)
+def get_repo_name(repo):
+    """
+    Read repo_name from repo profiles/repo_name, once per repository.
+    """
+    with open(os.path.join(repo, "profiles/repo_name"), "r") as f:
+        return f.read().strip()
+
+
+def read_batch_atoms(lines):
+    """
+    Atoms of a --batch list: one per line, empty lines and '#' comments are left out.
+
+    >>> read_batch_atoms(["=dev-libs/foo-1.2  # stabilization", "", "# done", "app-misc/bar\\n"])
+    ['=dev-libs/foo-1.2', 'app-misc/bar']
+    """
+    atoms = []
+    for line in lines:
+        atom = line.split("#", 1)[0].strip()
+        if atom:
+            atoms.append(atom)
+    return atoms
+
+
+def skip_jobs(jobs, skip, reason):
+    """
+    Leave out the jobs skip() is true for, lazily, logging every one of them.
+    """
+    from .scheduler import describe_job
+
+    for job in jobs:
+        if skip(job):
+            logging.info("Skipping {}: {}.".format(describe_job(job), reason))
+        else:
+            yield job
+
+
+def generate_manifests(ebuilds, args):
+    """
+    Run 'ebuild manifest' for the package directories of ebuilds, concurrently.
+
+    The manifest covers the whole package directory, so it is generated once per directory.
+    """
+    # dict as an ordered set
+    package_directories = {}
+    for ebuild in ebuilds:
+        package_directories.setdefault(os.path.dirname(os.path.abspath(ebuild)), ebuild)
+
+    from .test import run_cmd
+
+    def generate_manifest(ebuild):
+        logging.debug(f"ebuild {ebuild} manifest")
+        run_cmd(
+            ["ebuild", ebuild, "manifest"],
+            os.environ.copy(),
+            args.quiet,
+            args.pretend,
+        )
+
+    if not package_directories:
+        return
+
+    with ThreadPoolExecutor(
+        max_workers=min(len(package_directories), MAX_MANIFEST_JOBS)
+    ) as executor:
+        list(executor.map(generate_manifest, package_directories.values()))
+
+
 def pkg_testing_tool(args, extra_args):
-    results = []
+    # Imported here rather than at the top, so that --help and argument errors
+    # don't wait for the modules that run jobs (and asyncio) to load.
+    from .binpkgs import get_binpkg_cache
+    from .cache import get_metadata_cache, get_results_store, normalize_use_flags
+    from .job import define_jobs, get_job_key, get_job_use_flags, get_package_metadata
+    from .plan import build_shared_dependencies, plan_jobs
+    from .scheduler import run_jobs
+    from .snapshot import VdbSnapshot
+
+    previous_results = []
+
+    args.session_start = time.time()
+
+    if args.resume:
+        header, previous_results = load_journal(args.resume)
+        seed = header["seed"]
+        args.session_start = header["started"]
+        if args.seed is not None and args.seed != seed:
+            logging.warning(
+                "Ignoring --seed {}, resuming with seed {} from {}.".format(
+                    args.seed, seed, args.resume
+                )
+            )
+        args.seed = seed
+        logging.info(
+            "Resuming {} with {} finished jobs.".format(
+                args.resume, len(previous_results)
+            )
+        )
+
+    if args.seed is None:
+        args.seed = random.SystemRandom().getrandbits(32)
+
+    logging.info("Random seed: {}".format(args.seed))
 
     # Unconditionally unmask and keyword packages selected by atom.
     # No much of a reason to check what arch we're running or if package is masked in first place.
@@ -255,7 +848,15 @@ def pkg_testing_tool(args, extra_args):
                 get_etc_portage_tmp_file(directory, args.prefix)
             )
 
+        if args.batch:
+            if args.batch == "-":
+                args.package_atom += read_batch_atoms(sys.stdin)
+            else:
+                with open(args.batch) as batch:
+                    args.package_atom += read_batch_atoms(batch)
+
         repos = []
+        repos_conf = ""
         for ebuild in args.file:
             # test that file ends in ".ebuild"
             if not ebuild.endswith(".ebuild"):
@@ -264,16 +865,11 @@ def pkg_testing_tool(args, extra_args):
             repo = os.path.dirname(
                 os.path.dirname(os.path.dirname(os.path.abspath(ebuild)))
             )
-            # read repo_name from repo profiles/repo_name
-            repo_name = "zzzpkgtestingtool"
-            with open(os.path.join(repo, "profiles/repo_name"), "r") as f:
-                repo_name = f.read().strip()
+            repo_name = get_repo_name(repo)
             # only add repo once
             if repo_name not in repos:
                 repos += [repo_name]
-                tmp_files["repos.conf"].write(
-                    f"[{repo_name}]\npriority=9999\nlocation = {repo}\n"
-                )
+                repos_conf += f"[{repo_name}]\npriority=9999\nlocation = {repo}\n"
             # ebuild to category/package-X.Y.Z
             # get parent directory name of ebuild
             category = os.path.basename(
@@ -283,16 +879,11 @@ def pkg_testing_tool(args, extra_args):
             args.package_atom += [
                 "=" + category + "/" + package_version + "::" + repo_name
             ]
-            # make sure we have the right manifest already
-            logging.debug(f"ebuild {ebuild} manifest")
-            run_cmd(
-                ["ebuild", ebuild, "manifest"],
-                os.environ.copy(),
-                args.quiet,
-                args.pretend,
-            )
 
-        jobs = []
+        tmp_files["repos.conf"].write(repos_conf)
+
+        # make sure we have the right manifests already
+        generate_manifests(args.file, args)
 
         for atom in args.package_atom:
             # Unmask and keyword all the packages prior to testing them.
@@ -302,71 +893,244 @@ def pkg_testing_tool(args, extra_args):
         for handler in tmp_files:
             tmp_files[handler].flush()
 
-        for atom in args.package_atom:
-            for new_job in define_jobs(atom, args):
-                jobs.append(new_job)
+        cache_dir = args.cache_dir or args.prefix + DEFAULT_CACHE_DIR
+
+        metadata_cache = None
+        if not args.no_metadata_cache:
+            metadata_cache = get_metadata_cache(cache_dir)
+            if metadata_cache is not None:
+                stack.callback(metadata_cache.close)
 
-        padding = max(len(i["cpv"]) for i in jobs) + 3
+        results_store = None
+        if not args.no_results_cache:
+            results_store = get_results_store(cache_dir)
+            if results_store is not None:
+                stack.callback(results_store.close)
 
-        logging.info("Following testing jobs will be executed:")
-        for job in jobs:
+        binpkg_cache = None
+        if args.binpkg_cache:
+            binpkg_cache = get_binpkg_cache(
+                cache_dir, int(args.binpkg_cache_size * 1024**3)
+            )
+            if binpkg_cache is not None:
+                binpkg_cache.evict()
+                stack.callback(binpkg_cache.evict)
+
+        # A generator, so that in batch mode the jobs of an atom are only defined when they are about to run.
+        jobs = (
+            job
+            for atom in args.package_atom
+            for job in define_jobs(atom, args, metadata_cache, results_store)
+        )
+
+        if args.skip_tested and results_store is not None:
+            jobs = skip_jobs(
+                jobs,
+                lambda job: results_store.get_results(
+                    job["resolved_cpv"], job["inputs"]
+                ).get(
+                    (
+                        normalize_use_flags(" ".join(get_job_use_flags(job))),
+                        job["test_feature_toggle"],
+                    )
+                )
+                == 0,
+                "passed before",
+            )
+
+        if args.resume:
+            finished_jobs = set(get_result_key(result) for result in previous_results)
+            jobs = skip_jobs(
+                jobs, lambda job: get_job_key(job) in finished_jobs, "finished before"
+            )
+
+        if not args.batch:
+            jobs = list(jobs)
+
+        shared_dependencies = []
+        if args.plan and jobs:
+            jobs, shared_dependencies = plan_jobs(jobs, args, binpkg_cache)
+
+        if args.batch:
             logging.info(
-                "{cpv:<{padding}} USE: {use_flags}{test_feature}".format(
-                    cpv=job["cpv"],
-                    use_flags=(
-                        "<default flags>"
-                        if not job["use_flags"]
-                        else " ".join(job["use_flags"])
-                    ),
-                    test_feature=(
-                        ", FEATURES: test" if job["test_feature_toggle"] else ""
-                    ),
-                    padding=padding,
+                "Testing {} atoms from {}, defining their jobs as they run.".format(
+                    len(args.package_atom), args.batch
                 )
             )
+        else:
+            padding = max((len(i["cpv"]) for i in jobs), default=0) + 3
+
+            logging.info("Following testing jobs will be executed:")
+            for job in jobs:
+                logging.info(
+                    "{cpv:<{padding}} USE: {use_flags}{test_feature}".format(
+                        cpv=job["cpv"],
+                        use_flags=(
+                            "<default flags>"
+                            if job["use_mask"] is None
+                            else " ".join(get_job_use_flags(job))
+                        ),
+                        test_feature=(
+                            ", FEATURES: test" if job["test_feature_toggle"] else ""
+                        ),
+                        padding=padding,
+                    )
+                )
 
         if args.ask:
             if not yes_no(">>> Do you want to continue? [y/N]: "):
                 sys.exit(1)
 
-        i = 0
-        for job in jobs:
-            i += 1
+        build_shared_dependencies(shared_dependencies, args, binpkg_cache)
+
+        # After the shared dependencies are installed, so that they stay for all jobs.
+        snapshot = None
+        if args.snapshot:
+            snapshot = VdbSnapshot()
             logging.info(
-                "Running ({i} of {max_i}) {cpv} with USE: {use_flags}{test_feature}".format(
-                    i=i,
-                    max_i=len(jobs),
-                    cpv=job["cpv"],
-                    use_flags=(
-                        "<default flags>"
-                        if not job["use_flags"]
-                        else " ".join(job["use_flags"])
-                    ),
-                    test_feature=(
-                        ", FEATURES: test" if job["test_feature_toggle"] else ""
+                "Recorded {} installed packages to restore after every job.".format(
+                    len(snapshot.packages)
+                )
+            )
+
+        journal = None
+        if args.resume or args.journal:
+            journal = stack.enter_context(
+                open_journal(
+                    args.resume or args.journal,
+                    {"seed": args.seed, "started": args.session_start},
+                )
+            )
+
+        report_jsonl = None
+        if args.report_jsonl:
+            report_jsonl = stack.enter_context(JsonlWriter(args.report_jsonl, "w"))
+            for result in previous_results:
+                report_jsonl.write(result)
+
+        finished_results = []
+
+        def write_summary(state):
+            if args.report_summary:
+                write_json(
+                    args.report_summary,
+                    get_summary(
+                        previous_results + finished_results, args.session_start, state
                     ),
                 )
+
+        write_summary("running")
+
+        def on_result(result):
+            finished_results.append(result)
+            if args.batch and args.report:
+                write_report(args.report, previous_results + finished_results)
+            if report_jsonl is not None:
+                report_jsonl.write(result)
+            if journal is not None:
+                journal.write({"result": result})
+            write_summary("running")
+            # Results of --pretend runs are always successful, don't take them for real.
+            if results_store is not None and not args.pretend:
+                results_store.record(result)
+
+        try:
+            if args.coordinator:
+                from .distributed import serve_jobs
+
+                results = previous_results + serve_jobs(
+                    jobs, args, on_result, repos_conf
+                )
+            else:
+                results = previous_results + run_jobs(
+                    jobs, args, on_result, binpkg_cache, snapshot
+                )
+
+            if args.bisect_failures:
+                from .culprits import find_culprits
+
+                for failing in [
+                    result
+                    for result in results
+                    if result["exit_code"] not in (0, None)
+                    and result["use_flags"]
+                    and "bisect_of" not in result
+                ]:
+
+                    def on_bisect_result(result):
+                        result["bisect_of"] = failing["use_flags"]
+                        results.append(result)
+                        on_result(result)
+
+                    def run_bisect_job(job):
+                        bisect_results = run_jobs(
+                            [job], args, on_bisect_result, binpkg_cache, snapshot
+                        )
+                        return bisect_results[0] if bisect_results else None
+
+                    metadata = get_package_metadata(failing["atom"], metadata_cache)
+                    if args.append_required_use:
+                        metadata["ruse"].append(args.append_required_use)
+
+                    culprits = find_culprits(
+                        failing, results, metadata, args, run_bisect_job
+                    )
+                    if culprits is None:
+                        logging.warning(
+                            "No passing USE flag combination of {} to compare USE: {} with.".format(
+                                failing["atom"], failing["use_flags"]
+                            )
+                        )
+                        continue
+
+                    failing["culprit_use_flags"], failing["culprit_minimal"] = culprits
+                    logging.info(
+                        "{} fails with USE: {} because of: {}{}".format(
+                            failing["atom"],
+                            failing["use_flags"],
+                            " ".join(culprits[0]),
+                            "" if culprits[1] else " (or a subset, ran out of builds)",
+                        )
+                    )
+        except BaseException:
+            # Keep the report of the jobs that finished, also when a job exits the session
+            # (like on a missing CCACHE_DIR) or it is interrupted.
+            if args.report:
+                write_report(args.report, previous_results + finished_results)
+            write_summary("interrupted")
+            raise
+
+        if binpkg_cache is not None:
+            logging.info(
+                "Binary package cache: {} packages installed from it, {} built from source.".format(
+                    binpkg_cache.hits, binpkg_cache.misses
+                )
             )
-            results.append(run_testing(job, args))
-            if args.fail_fast and results[-1]["exit_code"] != 0:
-                logging.error("Exiting due to --fail-fast.")
-                break
 
     failures = []
     for item in results:
-        if item["exit_code"] != 0:
+        # Skipped jobs have no exit code, the failure that made them skipped is reported.
+        if item["exit_code"] not in (0, None):
             failures.append(item)
 
     if args.report:
-        with open(args.report, "w") as report:
-            report.write(json.dumps(results, indent=4, sort_keys=True))
+        write_report(args.report, results)
+    write_summary("finished")
 
     if len(failures) > 0:
         logging.error("Not all runs were successful.")
         for entry in failures:
             logging.error(
-                "atom: {atom}, USE flags: '{use_flags}'".format(
-                    atom=entry["atom"], use_flags=entry["use_flags"]
+                "atom: {atom}, USE flags: '{use_flags}'{culprits}".format(
+                    atom=entry["atom"],
+                    use_flags=entry["use_flags"],
+                    culprits=(
+                        ", because of: '{}'".format(
+                            " ".join(entry["culprit_use_flags"])
+                        )
+                        if "culprit_use_flags" in entry
+                        else ""
+                    ),
                 )
             )
         sys.exit(1)
@@ -375,6 +1139,20 @@ def pkg_testing_tool(args, extra_args):
 
 
 def run(sysargs):
+    if sysargs[:1] == ["worker"]:
+        from .distributed import run_worker
+
+        args = process_worker_args(sysargs[1:])
+        run_worker(args, args.cache_dir or args.prefix + DEFAULT_CACHE_DIR)
+        return
+
+    if sysargs[:1] == ["report"]:
+        from .report import run_report_command
+
+        args = process_report_args(sysargs[1:])
+        run_report_command(args, args.cache_dir or args.prefix + DEFAULT_CACHE_DIR)
+        return
+
     args, extra_args = process_args(sysargs)
 
     pkg_testing_tool(args, extra_args)
@@ -0,0 +1,242 @@
+import logging
+import os
+import re
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+from .portage_api import get_portage
+from .scheduler import describe_job
+from .supervisor import get_supervisor
+from .test import get_emerge_cmdline, run_cmd, write_job_config
+from .tmp import get_portage_configroot
+
+# Merge list entries of 'emerge --pretend --verbose', like
+# [ebuild  N     ] dev-libs/foo-1.2:0/1::gentoo  USE="a -b" 0 KiB
+PRETEND_LINE_RE = re.compile(r"^\[(ebuild|binary)\s*[^\]]*\]\s+(\S+)(.*)$")
+PRETEND_USE_RE = re.compile(r'\bUSE="([^"]*)"')
+
+
+def parse_pretend_output(output):
+    """
+    Packages in the merge list printed by 'emerge --pretend --verbose'.
+
+    :return: list of (merge type, atom, USE flags) tuples, the merge type being 'ebuild' or 'binary'
+
+    >>> parse_pretend_output('''
+    ... [ebuild  N     ] dev-libs/foo-1.2:0/1::gentoo  USE="b* -a (-c)" 0 KiB
+    ... [binary     U  ] sys-libs/zlib-1.3-r1:0/1::gentoo [1.2.13:0/1::gentoo] 0 KiB
+    ... [blocks B      ] app-misc/bar ("app-misc/bar" is blocking app-misc/baz-1)
+    ... ''')
+    [('ebuild', '=dev-libs/foo-1.2::gentoo', '-a -c b'), ('binary', '=sys-libs/zlib-1.3-r1::gentoo', '')]
+    """
+    packages = []
+
+    for line in output.splitlines():
+        match = PRETEND_LINE_RE.match(line.strip())
+        if match is None:
+            continue
+
+        merge_type, package, rest = match.groups()
+        cpv, _, repo = package.partition("::")
+        # Drop the slot and subslot.
+        cpv = cpv.partition(":")[0]
+
+        use_flags = ""
+        use_match = PRETEND_USE_RE.search(rest)
+        if use_match:
+            use_flags = " ".join(
+                sorted(flag.strip("()*%") for flag in use_match.group(1).split())
+            )
+
+        packages.append(
+            (
+                merge_type,
+                "={}::{}".format(cpv, repo) if repo else "=" + cpv,
+                use_flags,
+            )
+        )
+
+    return packages
+
+
+def resolve_job_dependencies(job, args, binpkg_cache=None):
+    """
+    Resolve the dependencies a job would merge, through 'emerge --pretend'
+    in a private PORTAGE_CONFIGROOT with the job's configuration.
+
+    :param binpkg_cache: BinpkgCache the job will take binary packages from, instead of PKGDIR
+
+    :return: set of (merge type, atom, USE flags) tuples, not including the tested package itself
+    """
+    with ExitStack() as stack:
+        config_root = stack.enter_context(get_portage_configroot(args.prefix))
+        write_job_config(job, stack, config_root)
+
+        env = os.environ.copy()
+        env["PORTAGE_CONFIGROOT"] = config_root
+        if binpkg_cache is not None:
+            binpkg_cache.set_env(env)
+
+        cmdline = get_emerge_cmdline(job, args, binpkg_cache is not None)
+        cmdline[1:1] = ["--pretend", "--color", "n", "--nospinner"]
+
+        logging.debug("Running command: {}".format(" ".join(cmdline)))
+        output = []
+        result = get_supervisor().run(cmdline, env, [output.append])
+        output = b"".join(output).decode(errors="replace")
+
+    if result.returncode != 0:
+        logging.warning(
+            "Could not resolve dependencies of {}, exit code: {}".format(
+                describe_job(job), result.returncode
+            )
+        )
+        logging.debug("Output: %s", output)
+        return set()
+
+    return set(
+        package
+        for package in parse_pretend_output(output)
+        if get_portage().versions.cpv_getkey(package[1][1:].partition("::")[0])
+        != job["cp"]
+    )
+
+
+def order_jobs(jobs, dependencies, keep_first_per_cpv=False):
+    """
+    Order jobs greedily, so that every job shares as many dependencies as possible
+    with the one before it. The first job stays first.
+
+    :param jobs: jobs as defined by define_jobs()
+    :param dependencies: sets of dependencies of the jobs, in the same order
+    :param keep_first_per_cpv: keep the first job of every cpv before its other jobs
+    :return: indices of the jobs, in the new order
+
+    >>> jobs = [{"cpv": "=a/b-1"}, {"cpv": "=a/c-1"}, {"cpv": "=a/c-1"}]
+    >>> order_jobs(jobs, [{"x", "y"}, {"z"}, {"x"}])
+    [0, 2, 1]
+    >>> order_jobs(jobs, [{"x", "y"}, {"z"}, {"x"}], keep_first_per_cpv=True)
+    [0, 1, 2]
+    """
+    first_per_cpv = {}
+    for i, job in enumerate(jobs):
+        first_per_cpv.setdefault(job["cpv"], i)
+
+    order = []
+    remaining = list(range(len(jobs)))
+
+    while remaining:
+        available = [
+            i
+            for i in remaining
+            if not keep_first_per_cpv
+            or first_per_cpv[jobs[i]["cpv"]] == i
+            or first_per_cpv[jobs[i]["cpv"]] in order
+        ]
+
+        if not order:
+            best = available[0]
+        else:
+            previous = dependencies[order[-1]]
+            # Most shared dependencies, then fewest new ones, then the defined order.
+            best = min(
+                available,
+                key=lambda i: (
+                    -len(dependencies[i] & previous),
+                    len(dependencies[i] - previous),
+                    i,
+                ),
+            )
+
+        order.append(best)
+        remaining.remove(best)
+
+    return order
+
+
+def plan_jobs(jobs, args, binpkg_cache=None):
+    """
+    Resolve the dependencies of all jobs up front, in parallel, and order the jobs
+    so that consecutive jobs share the most dependencies.
+
+    :param binpkg_cache: BinpkgCache the jobs will take binary packages from, instead of PKGDIR
+
+    :return: ordered jobs, atoms of the dependencies built from source by more than one job
+    """
+    workers = args.parallel if args.parallel > 1 else os.cpu_count() or 1
+
+    logging.info(
+        "Resolving dependencies of {} jobs, {} at a time.".format(len(jobs), workers)
+    )
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        dependencies = list(
+            executor.map(
+                lambda job: resolve_job_dependencies(job, args, binpkg_cache), jobs
+            )
+        )
+
+    all_dependencies = set().union(*dependencies)
+    usage = Counter(package for packages in dependencies for package in packages)
+    shared = sorted(
+        set(
+            atom
+            for (merge_type, atom, use_flags), count in usage.items()
+            if merge_type == "ebuild" and count > 1
+        )
+    )
+
+    logging.info(
+        "Jobs pull in {} different packages, {} to be built from source are shared by several jobs.".format(
+            len(all_dependencies), len(shared)
+        )
+    )
+
+    order = order_jobs(
+        jobs, dependencies, keep_first_per_cpv=args.test_feature_scope == "first"
+    )
+
+    return [jobs[i] for i in order], shared
+
+
+def build_shared_dependencies(shared, args, binpkg_cache=None):
+    """
+    Build dependencies shared by several jobs once, as binary packages the jobs then
+    install through --usepkg.
+
+    :param shared: atoms of the dependencies, as returned by plan_jobs()
+    :param binpkg_cache: BinpkgCache to build the binary packages into, instead of PKGDIR
+    """
+    if not shared:
+        return
+
+    if not args.binpkg:
+        logging.info(
+            "Not prebuilding {} shared dependencies, as jobs only use binary packages with --binpkg.".format(
+                len(shared)
+            )
+        )
+        return
+
+    logging.info("Building {} shared dependencies.".format(len(shared)))
+
+    env = os.environ.copy()
+    with ExitStack() as stack:
+        if binpkg_cache is not None:
+            binpkg_cache.set_env(env)
+            stack.enter_context(binpkg_cache.use())
+
+        result = run_cmd(
+            ["emerge", "--oneshot", "--usepkg", "--buildpkg=y"]
+            + (["--binpkg-respect-use=y"] if binpkg_cache is not None else [])
+            + shared,
+            env,
+            args.quiet,
+            args.pretend,
+        )
+
+    if result is not None and result.returncode != 0:
+        logging.warning(
+            "Building shared dependencies failed, jobs will build them on their own."
+        )
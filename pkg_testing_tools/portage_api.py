@@ -0,0 +1,42 @@
+"""
+Deferred access to Portage.
+
+Importing portage, and even more so the first use of portage.settings or portage.db,
+loads the configuration and scans the repositories. Modules get Portage through these
+accessors when they need it instead of importing it at import time, so that --help,
+argument errors and commands that never query Portage start right away.
+
+>>> import subprocess, sys
+>>> subprocess.run(
+...     [sys.executable, "-c", "import sys, pkg_testing_tools.main, pkg_testing_tools.plan; print('portage' in sys.modules)"],
+...     capture_output=True, text=True,
+... ).stdout
+'False\\n'
+"""
+
+import functools
+
+
+@functools.lru_cache(maxsize=None)
+def get_portage():
+    """
+    The portage module, imported on first use.
+    """
+    import portage
+
+    return portage
+
+
+def get_settings():
+    """
+    portage.settings, the configuration of the running system.
+    """
+    return get_portage().settings
+
+
+def get_portdb():
+    """
+    Database of the ebuild repositories of the running system.
+    """
+    portage = get_portage()
+    return portage.db[portage.root]["porttree"].dbapi
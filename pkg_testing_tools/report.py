@@ -0,0 +1,296 @@
+import datetime
+import json
+import logging
+import os
+import sys
+
+from .portage_api import get_portage
+
+
+class JsonlWriter:
+    """
+    Append-only JSON Lines file, every record is flushed and fsync'd right away,
+    so it survives the process being killed.
+
+    :param mode: "w" to start the file over
+    """
+
+    def __init__(self, path, mode="a"):
+        self.path = path
+        self.file = open(path, mode)
+
+    def write(self, record):
+        self.file.write(json.dumps(record, sort_keys=True) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_jsonl(path):
+    """
+    Read the records of a JSON Lines file, skipping a last line cut short by a crash.
+    """
+    records = []
+
+    with open(path, "r") as jsonl:
+        lines = jsonl.read().splitlines()
+
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            if number != len(lines):
+                raise
+            logging.warning("Ignoring truncated last line of {}".format(path))
+
+    return records
+
+
+def get_result_key(result):
+    """
+    Key identifying the job a result belongs to, see get_job_key().
+
+    >>> get_result_key({"atom": "=a/b-1", "use_flags": "x -y", "test_feature_toggle": True})
+    ('=a/b-1', 'x -y', True)
+    """
+    return (result["atom"], result["use_flags"], result["test_feature_toggle"])
+
+
+def load_journal(path):
+    """
+    Load a journal written by open_journal().
+
+    :return: header of the session, list of results of completed jobs
+    """
+    header = {}
+    results = []
+
+    for record in read_jsonl(path):
+        if "header" in record:
+            header = record["header"]
+        if "result" in record:
+            results.append(record["result"])
+
+    return header, results
+
+
+def open_journal(path, header):
+    """
+    Open a checkpoint journal, which records a header with the settings of the session
+    (like its seed) and the result of every job as soon as it finished.
+    """
+    is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+
+    if not is_new:
+        # Drop a last line cut short by a crash, so that new records start on a line of their own.
+        with open(path, "rb+") as jsonl:
+            content = jsonl.read()
+            if not content.endswith(b"\n"):
+                jsonl.truncate(content.rfind(b"\n") + 1)
+
+    journal = JsonlWriter(path)
+
+    if is_new:
+        journal.write({"header": header})
+
+    return journal
+
+
+def write_json(path, data):
+    """
+    Write a JSON file, replacing the previous one at once, so a file being
+    rewritten while jobs run is never seen half written.
+    """
+    tmp_path = "{}.tmp{}".format(path, os.getpid())
+    with open(tmp_path, "w") as output:
+        output.write(json.dumps(data, indent=4, sort_keys=True))
+    os.replace(tmp_path, path)
+
+
+def write_report(path, results):
+    """
+    Write the JSON report, see write_json().
+    """
+    write_json(path, results)
+
+
+def get_summary(results, started, state, updated=None):
+    """
+    Summary of the session so far, for --report-summary.
+
+    :param started: timestamp the session started at
+    :param state: "running", "finished" or "interrupted"
+    :param updated: timestamp of the summary, now by default
+
+    >>> summary = get_summary([{"atom": "=a/b-1", "use_flags": "x", "test_feature_toggle": False, "exit_code": 0}, {"atom": "=a/b-1", "use_flags": "-x", "test_feature_toggle": True, "exit_code": 1}], 0, "running", 60)
+    >>> summary["finished"], summary["passed"], summary["failed"], summary["failures"]
+    (2, 1, 1, [{'atom': '=a/b-1', 'use_flags': '-x', 'test_feature_toggle': True, 'exit_code': 1}])
+    """
+    if updated is None:
+        updated = datetime.datetime.now().timestamp()
+
+    failures = [
+        {
+            key: result[key]
+            for key in ["atom", "use_flags", "test_feature_toggle", "exit_code"]
+        }
+        for result in results
+        if result["exit_code"] not in (0, None)
+    ]
+    skipped = sum(1 for result in results if "skipped" in result)
+
+    return {
+        "state": state,
+        "started": datetime.datetime.fromtimestamp(started)
+        .replace(microsecond=0)
+        .isoformat(),
+        "updated": datetime.datetime.fromtimestamp(updated)
+        .replace(microsecond=0)
+        .isoformat(),
+        "finished": len(results),
+        "passed": len(results) - len(failures) - skipped,
+        "failed": len(failures),
+        "skipped": skipped,
+        "failures": failures,
+    }
+
+
+def get_report_cp(entry):
+    """
+    Get the category/package of a report entry, also for reports without "cp".
+
+    >>> get_report_cp({"atom": "=dev-libs/foo-1.2.3-r1"})
+    'dev-libs/foo'
+    """
+    if "cp" in entry:
+        return entry["cp"]
+    portage = get_portage()
+    try:
+        return portage.dep.Atom(entry["atom"]).cp
+    except portage.exception.InvalidAtom:
+        return entry["atom"]
+
+
+def get_report_duration(entry):
+    """
+    Get the duration of a report entry in seconds, from the timings of its commands if recorded.
+
+    >>> get_report_duration({"time": {"started": "2024-01-01T10:00:00", "finished": "2024-01-01T10:30:00"}})
+    1800.0
+    >>> get_report_duration({"timings": {"commands": {"depclean": 20.5, "emerge": 1779.25}}})
+    1799.75
+    """
+    if "timings" in entry:
+        return sum(entry["timings"]["commands"].values())
+
+    started = datetime.datetime.fromisoformat(entry["time"]["started"])
+    finished = datetime.datetime.fromisoformat(entry["time"]["finished"])
+    return (finished - started).total_seconds()
+
+
+def parse_since(value, now=None):
+    """
+    Parse a point in time given as an age like '30d', '12h' or '90m', or an ISO date.
+
+    :return: timestamp
+
+    >>> parse_since("30d", now=86400 * 31)
+    86400.0
+    >>> parse_since("2024-01-01T00:00:00+00:00")
+    1704067200.0
+    """
+    units = {"m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+    if value[-1:] in units and value[:-1].isdigit():
+        if now is None:
+            now = datetime.datetime.now().timestamp()
+        return float(now - int(value[:-1]) * units[value[-1]])
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def read_report_entries(path):
+    """
+    Read the results in a JSON report, a checkpoint journal or a JSON Lines report.
+    """
+    with open(path, "r") as report:
+        content = report.read()
+
+    if content.lstrip().startswith("["):
+        return json.loads(content)
+
+    entries = []
+    for record in read_jsonl(path):
+        # Journals wrap results and start with a header.
+        record = record.get("result", record)
+        if "atom" in record:
+            entries.append(record)
+    return entries
+
+
+def format_run(entry):
+    """
+    One line summary of a report entry.
+
+    >>> format_run({"atom": "=a/b-1", "use_flags": "x -y", "test_feature_toggle": True, "exit_code": 1, "time": {"started": "2024-01-01T10:00:00"}})
+    '2024-01-01T10:00:00  exit code 1  =a/b-1  USE: x -y  FEATURES: test'
+    """
+    line = "{}  exit code {}  {}  USE: {}".format(
+        entry["time"]["started"] if entry.get("time") else "-",
+        entry["exit_code"],
+        entry["atom"],
+        entry["use_flags"] or "<default flags>",
+    )
+    if entry["test_feature_toggle"]:
+        line += "  FEATURES: test"
+    return line
+
+
+def run_report_command(args, cache_dir):
+    """
+    Run 'pkg-testing-tool report', on the runs in the results store in cache_dir.
+    """
+    from .cache import get_results_store
+
+    store = get_results_store(cache_dir)
+    if store is None:
+        sys.exit(1)
+
+    try:
+        if args.command == "import":
+            added = 0
+            for path in args.files:
+                for entry in read_report_entries(path):
+                    added += store.add_run(entry)
+            store.connection.commit()
+            logging.info(
+                "Imported {} runs into {}, the others were there already.".format(
+                    added, store.path
+                )
+            )
+            return
+
+        entries = store.query_runs(
+            cp=args.cp,
+            atom=args.atom,
+            use_flags=args.use,
+            failed=args.failed,
+            since=args.since,
+            limit=args.limit,
+        )
+    finally:
+        store.close()
+
+    if args.json:
+        print(json.dumps(entries, indent=4, sort_keys=True))
+    else:
+        for entry in entries:
+            print(format_run(entry))
@@ -0,0 +1,460 @@
+import collections
+import json
+import logging
+import os
+import shlex
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import ExitStack
+
+from .job import get_job_use_flags
+from .portage_api import get_settings
+from .report import get_report_cp, get_report_duration
+from .supervisor import CommandCancelled, get_supervisor
+from .test import JobConfig, run_testing
+from .tmp import get_portage_configroot
+
+# Guessed duration of a job without history, in seconds.
+DEFAULT_JOB_COST = 600.0
+# FEATURES=test usually at least doubles the build time.
+TEST_FEATURE_COST_FACTOR = 2.0
+# Every enabled USE flag tends to pull in more code to build.
+USE_FLAG_COST_FACTOR = 0.02
+
+
+def describe_job(job):
+    return "{cpv} with USE: {use_flags}{test_feature}".format(
+        cpv=job["cpv"],
+        use_flags=(
+            "<default flags>"
+            if job["use_mask"] is None
+            else " ".join(get_job_use_flags(job))
+        ),
+        test_feature=", FEATURES: test" if job["test_feature_toggle"] else "",
+    )
+
+
+def load_history(paths):
+    """
+    Load durations and memory usage of previous runs from JSON reports.
+
+    :param paths: paths of reports written by --report
+    :return: dict of cp to list of (test_feature_toggle, duration, max_rss in bytes)
+    """
+    history = {}
+
+    for path in paths or []:
+        with open(path, "r") as report:
+            for entry in json.load(report):
+                if "skipped" in entry:
+                    continue
+                max_rss = entry.get("resources", {}).get("max_rss", 0)
+                history.setdefault(get_report_cp(entry), []).append(
+                    (
+                        entry["test_feature_toggle"],
+                        get_report_duration(entry),
+                        max_rss,
+                    )
+                )
+
+    return history
+
+
+def estimate_job_cost(job, history):
+    """
+    Estimate how long a job takes, in seconds.
+
+    Previous runs of the same package with the same FEATURES=test toggle are preferred,
+    otherwise a default guess is scaled by FEATURES=test and the number of enabled USE flags.
+
+    :param job: job as defined by define_jobs()
+    :param history: as returned by load_history()
+    :return: estimated duration
+
+    >>> estimate_job_cost({"cp": "a/b", "test_feature_toggle": True, "use_mask": 1}, {})
+    1224.0
+    >>> estimate_job_cost({"cp": "a/b", "test_feature_toggle": False, "use_mask": None}, {"a/b": [(False, 60.0, 0), (True, 600.0, 0)]})
+    60.0
+    """
+    enabled_flags = 0 if job["use_mask"] is None else job["use_mask"].bit_count()
+    runs = history.get(job["cp"], [])
+    durations = [
+        duration for toggle, duration, _ in runs if toggle == job["test_feature_toggle"]
+    ]
+
+    if durations:
+        return sum(durations) / len(durations)
+
+    cost = DEFAULT_JOB_COST
+    if runs:
+        cost = sum(duration for _, duration, _ in runs) / len(runs)
+    if job["test_feature_toggle"]:
+        cost *= TEST_FEATURE_COST_FACTOR
+    return cost * (1 + USE_FLAG_COST_FACTOR * enabled_flags)
+
+
+def estimate_job_memory(job, history):
+    """
+    Estimate the peak memory usage of a job in bytes, 0 if unknown.
+    """
+    return max((max_rss for _, _, max_rss in history.get(job["cp"], [])), default=0)
+
+
+def get_makeopts(makeopts, jobs, load):
+    """
+    Replace the job and load limits in MAKEOPTS.
+
+    >>> get_makeopts("--quiet -j64 -l 64", 4, 16)
+    '--quiet -j4 -l16'
+    """
+    tokens = shlex.split(makeopts)
+    kept = []
+    skip = False
+    for token in tokens:
+        if skip:
+            skip = False
+        elif token in ["-j", "-l", "--jobs", "--load-average"]:
+            skip = True
+        elif not token.startswith(("-j", "-l", "--jobs=", "--load-average=")):
+            kept.append(token)
+    return " ".join(kept + ["-j{}".format(jobs), "-l{}".format(load)])
+
+
+class ResourceBudget:
+    """
+    CPUs and memory shared by concurrently running jobs.
+
+    Free CPUs are split between the jobs that can still start, a job waits while
+    its predicted memory does not fit, unless nothing else is running.
+    """
+
+    def __init__(self, cpus, memory, slots):
+        self.cpus = cpus
+        self.memory = memory
+        self.slots = slots
+        self.free_cpus = cpus
+        self.free_memory = memory
+        self.running = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, memory, jobs_left):
+        """
+        Wait for the CPUs and memory of a job.
+
+        :param jobs_left: jobs not finished yet, including this one, None if not known
+        :return: number of CPUs for the job
+        """
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.running == 0
+                or (
+                    self.free_cpus > 0
+                    and (not self.memory or self.free_memory >= memory)
+                )
+            )
+            # Split the free CPUs between this job and the ones that can still start next to it.
+            starting = (
+                self.slots if jobs_left is None else min(self.slots, jobs_left)
+            ) - self.running
+            cpus = max(1, self.free_cpus // max(1, starting))
+            self.free_cpus -= cpus
+            self.free_memory -= memory
+            self.running += 1
+            return cpus
+
+    def release(self, cpus, memory):
+        with self.condition:
+            self.free_cpus += cpus
+            self.free_memory += memory
+            self.running -= 1
+            self.condition.notify_all()
+
+
+def get_skipped_result(job, reason):
+    """
+    Report entry of a job that was not run, with no exit code.
+    """
+    return {
+        "use_flags": " ".join(get_job_use_flags(job)),
+        "exit_code": None,
+        "skipped": reason,
+        "test_feature_toggle": job["test_feature_toggle"],
+        "atom": job["cpv"],
+        "cp": job["cp"],
+        "cpv": job.get("resolved_cpv"),
+        "inputs": job.get("inputs"),
+    }
+
+
+class JobQueue:
+    """
+    Jobs waiting to run, as (index, job) pairs taken from order, lazily.
+
+    With prune, once a job failed (see record_failure()), queued jobs of the same atom
+    and FEATURES=test toggle with the very same USE flags are skipped, and those that
+    enable at least the USE flags the failing job enabled are moved to the end of the
+    queue, so that jobs more likely to tell something new run first.
+
+    :param on_skip: called with the index and the report entry of every skipped job
+
+    >>> jobs = [{"cpv": "a/b", "cp": "a/b", "iuse": ["x", "y"], "test_feature_toggle": False, "use_mask": mask} for mask in [0b01, 0b11, 0b10, 0b01]]
+    >>> jobs.append({"cpv": "a/c", "cp": "a/c", "iuse": [], "test_feature_toggle": False, "use_mask": 0})
+    >>> queue = JobQueue(enumerate(jobs), prune=True, on_skip=lambda i, result: print("skipped", i))
+    >>> i, job = next(queue)
+    >>> queue.record_failure(job)
+    >>> [i for i, job in queue]
+    skipped 3
+    [2, 4, 1]
+    """
+
+    def __init__(self, order, prune=False, on_skip=None):
+        self.order = iter(order)
+        self.prune = prune
+        self.on_skip = on_skip
+        self.deferred = collections.deque()
+        self.skipped = 0
+        # (cpv, test_feature_toggle): USE flag masks of the failed jobs
+        self.failures = {}
+
+    def __iter__(self):
+        return self
+
+    def record_failure(self, job):
+        if self.prune:
+            self.failures.setdefault(
+                (job["cpv"], job["test_feature_toggle"]), []
+            ).append(job["use_mask"])
+
+    def get_failed_masks(self, job):
+        return self.failures.get((job["cpv"], job["test_feature_toggle"]), [])
+
+    def is_repeat(self, job):
+        return job["use_mask"] in self.get_failed_masks(job)
+
+    def shares_failing_flags(self, job):
+        return job["use_mask"] is not None and any(
+            mask is not None and job["use_mask"] & mask == mask
+            for mask in self.get_failed_masks(job)
+        )
+
+    def skip(self, i, job):
+        self.skipped += 1
+        logging.warning("Skipping {}, it failed already.".format(describe_job(job)))
+        if self.on_skip is not None:
+            self.on_skip(i, get_skipped_result(job, "failed already"))
+
+    def __next__(self):
+        for i, job in self.order:
+            if self.is_repeat(job):
+                self.skip(i, job)
+            elif self.shares_failing_flags(job):
+                self.deferred.append((i, job))
+            else:
+                return i, job
+
+        while self.deferred:
+            i, job = self.deferred.popleft()
+            if self.is_repeat(job):
+                self.skip(i, job)
+            else:
+                return i, job
+
+        raise StopIteration
+
+
+def run_job(
+    job,
+    args,
+    i,
+    max_i,
+    job_config,
+    config_root=None,
+    makeopts=None,
+    binpkg_cache=None,
+    snapshot=None,
+):
+    """
+    Run a job, with its configuration written to job_config in config_root.
+
+    :param max_i: number of jobs, None if not known yet
+    """
+    logging.info(
+        "Running ({i} of {max_i}) {job}".format(
+            i=i, max_i="?" if max_i is None else max_i, job=describe_job(job)
+        )
+    )
+
+    return run_testing(
+        job, args, config_root, makeopts, job_config, binpkg_cache, snapshot
+    )
+
+
+def run_jobs(jobs, args, on_result=None, binpkg_cache=None, snapshot=None):
+    """
+    Run testing jobs, up to args.parallel at a time.
+
+    The configuration of a job is written to files that are rewritten in place for
+    every job, see JobConfig. With more than one job at a time, every worker gets its
+    own PORTAGE_CONFIGROOT, see get_portage_configroot(), and jobs share args.cpu_budget
+    CPUs through MAKEOPTS. Jobs given as a list are started longest first, as estimated
+    by estimate_job_cost(), other iterables are consumed lazily, in order. With
+    args.prune_failing, jobs are taken through a JobQueue that skips or postpones jobs
+    of failed packages, skipped jobs get a report entry without exit code.
+
+    :param jobs: jobs as defined by define_jobs(), as a list or any iterable
+    :param args: parsed command line arguments
+    :param on_result: called with every result as soon as its job finished
+    :param binpkg_cache: BinpkgCache shared by the jobs, see run_testing()
+    :param snapshot: VdbSnapshot to restore after every job, only with one job at a time
+    :return: results of the jobs that were run or skipped, in the order the jobs were defined
+    """
+    max_i = len(jobs) if isinstance(jobs, list) else None
+    results = {}
+
+    def on_skip(i, result):
+        results[i] = result
+        if on_result is not None:
+            on_result(result)
+
+    if args.parallel <= 1:
+        queue = JobQueue(enumerate(jobs), args.prune_failing, on_skip)
+        with JobConfig(args.prefix) as job_config:
+            for i, job in queue:
+                result = run_job(
+                    job,
+                    args,
+                    i + 1,
+                    max_i,
+                    job_config,
+                    binpkg_cache=binpkg_cache,
+                    snapshot=snapshot,
+                )
+                results[i] = result
+                if on_result is not None:
+                    on_result(result)
+                if result["exit_code"] != 0:
+                    if args.fail_fast:
+                        logging.error("Exiting due to --fail-fast.")
+                        break
+                    queue.record_failure(job)
+        return [results[i] for i in sorted(results)]
+
+    stop = threading.Event()
+
+    history = load_history(args.history)
+    if max_i is None:
+        order = enumerate(jobs)
+    else:
+        costs = [estimate_job_cost(job, history) for job in jobs]
+        order = (
+            (i, jobs[i]) for i in sorted(range(len(jobs)), key=lambda i: -costs[i])
+        )
+    queue = JobQueue(order, args.prune_failing, on_skip)
+
+    cpu_budget = args.cpu_budget or os.cpu_count() or 1
+    budget = ResourceBudget(
+        cpu_budget, int(args.memory_budget * 1024**3), args.parallel
+    )
+    jobs_left = [max_i]
+    # As portage sees it, from make.conf and the environment, as it overrides both.
+    base_makeopts = get_settings().get("MAKEOPTS", "")
+
+    # PORTAGE_CONFIGROOT and JobConfig of every worker thread, kept for all its jobs.
+    worker_configs = threading.local()
+    config_stack = ExitStack()
+    config_stack_lock = threading.Lock()
+
+    def get_worker_config():
+        if not hasattr(worker_configs, "job_config"):
+            with config_stack_lock:
+                worker_configs.config_root = config_stack.enter_context(
+                    get_portage_configroot(args.prefix)
+                )
+                worker_configs.job_config = config_stack.enter_context(
+                    JobConfig(worker_configs.config_root)
+                )
+        return worker_configs.config_root, worker_configs.job_config
+
+    def worker(i, job):
+        if stop.is_set():
+            return None
+
+        memory = estimate_job_memory(job, history)
+        cpus = budget.acquire(
+            memory, None if jobs_left[0] is None else jobs_left[0] - queue.skipped
+        )
+        try:
+            logging.debug(
+                "Estimated cost of {}: {:.0f}s, using {} CPUs".format(
+                    describe_job(job), estimate_job_cost(job, history), cpus
+                )
+            )
+            config_root, job_config = get_worker_config()
+            result = run_job(
+                job,
+                args,
+                i + 1,
+                max_i,
+                job_config,
+                config_root,
+                get_makeopts(base_makeopts, cpus, cpu_budget),
+                binpkg_cache,
+            )
+        except CommandCancelled:
+            logging.warning("Cancelled {}".format(describe_job(job)))
+            return None
+        finally:
+            if jobs_left[0] is not None:
+                with budget.condition:
+                    jobs_left[0] -= 1
+            budget.release(cpus, memory)
+
+        if args.fail_fast and result["exit_code"] != 0 and not stop.is_set():
+            stop.set()
+            logging.error("Exiting due to --fail-fast, killing running jobs.")
+            get_supervisor().cancel_all()
+
+        return result
+
+    with config_stack, ThreadPoolExecutor(max_workers=args.parallel) as executor:
+        futures = {}
+
+        def submit_next():
+            # Jobs are only taken from the iterable when a worker is about to be free.
+            for i, job in queue:
+                futures[executor.submit(worker, i, job)] = (i, job)
+                return
+
+        try:
+            for _ in range(args.parallel):
+                submit_next()
+
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i, job = futures.pop(future)
+                    result = future.result()
+
+                    if result is not None:
+                        results[i] = result
+                        if result["exit_code"] != 0:
+                            queue.record_failure(job)
+                        if on_result is not None:
+                            on_result(result)
+                        logging.info(
+                            "Finished ({i} of {max_i}) {job}, exit code: {exit_code}".format(
+                                i=i + 1,
+                                max_i="?" if max_i is None else max_i,
+                                job=describe_job(job),
+                                exit_code=result["exit_code"],
+                            )
+                        )
+
+                    if not stop.is_set():
+                        submit_next()
+        except BaseException:
+            stop.set()
+            get_supervisor().cancel_all()
+            raise
+
+    return [results[i] for i in sorted(results)]
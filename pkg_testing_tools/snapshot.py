@@ -0,0 +1,97 @@
+import logging
+import os
+
+from .portage_api import get_portage, get_settings
+
+
+def read_vdb(vdb_path):
+    """
+    Installed packages, from the package database (VDB) in vdb_path.
+
+    :return: dict of cpv: COUNTER, which changes whenever a package is merged again
+    """
+    packages = {}
+
+    # Nothing was ever installed to a new ROOT.
+    if not os.path.isdir(vdb_path):
+        return packages
+
+    with os.scandir(vdb_path) as categories:
+        for category in categories:
+            if not category.is_dir() or category.name.startswith((".", "-")):
+                continue
+            with os.scandir(category.path) as entries:
+                for entry in entries:
+                    # Skips the -MERGING- directories of merges in progress.
+                    if not entry.is_dir() or entry.name.startswith((".", "-")):
+                        continue
+                    cpv = category.name + "/" + entry.name
+                    try:
+                        with open(os.path.join(entry.path, "COUNTER")) as counter:
+                            packages[cpv] = counter.read().strip()
+                    except OSError:
+                        packages[cpv] = None
+
+    return packages
+
+
+def get_restore_actions(snapshot, current):
+    """
+    Packages to unmerge and to merge again to get from the installed packages current
+    back to snapshot, both as returned by read_vdb().
+
+    :return: cpvs merged since the snapshot, cpvs removed or merged again since the snapshot
+
+    >>> get_restore_actions({"a/b-1": "10", "a/c-1": "11", "a/d-1": "12"}, {"a/b-1": "10", "a/c-1": "20", "a/d-2": "21", "a/e-1": "22"})
+    (['a/d-2', 'a/e-1'], ['a/c-1', 'a/d-1'])
+    """
+    unmerge = sorted(cpv for cpv in current if cpv not in snapshot)
+    merge = sorted(
+        cpv
+        for cpv, counter in snapshot.items()
+        if cpv not in current or current[cpv] != counter
+    )
+    return unmerge, merge
+
+
+class VdbSnapshot:
+    """
+    Set of installed packages, taken before the session, that the system is brought
+    back to after every job by unmerging exactly the packages the job merged and merging
+    again those it replaced, instead of --unmerge/--depclean resolving the whole system.
+
+    Merging again uses binary packages where they exist (see --binpkg), with --nodeps,
+    as the dependencies of the snapshot were installed at the time.
+    """
+
+    def __init__(self, vdb_path=None):
+        if vdb_path is None:
+            vdb_path = os.path.join(get_settings()["EROOT"], get_portage().VDB_PATH)
+        self.vdb_path = vdb_path
+        self.packages = read_vdb(vdb_path)
+
+    def get_restore_cmdlines(self):
+        """
+        emerge command lines bringing the installed packages back to the snapshot.
+        """
+        unmerge, merge = get_restore_actions(self.packages, read_vdb(self.vdb_path))
+        cmdlines = []
+
+        if unmerge:
+            logging.info(
+                "Unmerging {} packages merged since the snapshot.".format(len(unmerge))
+            )
+            cmdlines.append(["emerge", "--rage-clean"] + ["=" + cpv for cpv in unmerge])
+
+        if merge:
+            logging.info(
+                "Merging again {} packages replaced since the snapshot.".format(
+                    len(merge)
+                )
+            )
+            cmdlines.append(
+                ["emerge", "--oneshot", "--usepkg", "--nodeps"]
+                + ["=" + cpv for cpv in merge]
+            )
+
+        return cmdlines
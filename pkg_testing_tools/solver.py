@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+
+"""
+Compile REQUIRED_USE into a binary decision diagram (BDD).
+
+The diagram is built once per package and answers validity, counting,
+enumeration and sparse/dense queries directly, instead of testing candidate
+USE combinations one by one with portage.dep.check_required_use().
+
+USE combinations are addressed by the same index as get_use_flags_toggles():
+bit i of the index enables iuse[i].
+"""
+
+import functools
+import random
+from typing import Iterable
+
+from .portage_api import get_portage
+
+FALSE = 0
+TRUE = 1
+
+GROUP_OPERATORS = ("||", "^^", "??")
+
+
+def invalid_depend_string(message):
+    """
+    The exception portage raises for malformed REQUIRED_USE, portage being imported on first use.
+    """
+    return get_portage().exception.InvalidDependString(message)
+
+
+def parse_required_use(ruse: list[str]) -> list[tuple]:
+    """
+    Parse REQUIRED_USE tokens into a tree of (operator, argument) tuples.
+
+    Leaves are ("flag", token), plain groups are ("()", children), and
+    operators/conditionals carry their token, like ("||", children) or ("foo?", children).
+
+    :param ruse: list of REQUIRED_USE tokens or strings
+    :return: list of top-level nodes
+
+    >>> parse_required_use(["|| ( a b )", "c?", "(", "!d", ")"])
+    [('||', [('flag', 'a'), ('flag', 'b')]), ('c?', [('flag', '!d')])]
+    >>> parse_required_use(["|| a"])
+    Traceback (most recent call last):
+    ...
+    portage.exception.InvalidDependString: malformed syntax: '|| a'
+    """
+    required_use = " ".join(ruse)
+    stack = [[]]
+    operators = []
+    pending = None
+
+    for token in required_use.split():
+        if token == "(":
+            stack.append([])
+            operators.append(pending or "()")
+            pending = None
+        elif token == ")":
+            if pending is not None or len(stack) == 1:
+                raise invalid_depend_string("malformed syntax: '%s'" % required_use)
+            children = stack.pop()
+            stack[-1].append((operators.pop(), children))
+        elif pending is not None:
+            raise invalid_depend_string("malformed syntax: '%s'" % required_use)
+        elif token in GROUP_OPERATORS or token.endswith("?"):
+            pending = token
+        else:
+            stack[-1].append(("flag", token))
+
+    if pending is not None or len(stack) != 1:
+        raise invalid_depend_string("malformed syntax: '%s'" % required_use)
+
+    return stack[0]
+
+
+class RequiredUseSolver:
+    """
+    REQUIRED_USE of a package compiled against its (filtered) IUSE.
+
+    Flags referenced by REQUIRED_USE but missing from iuse are treated as
+    disabled, and '-flag' tokens as '!flag', which matches how
+    portage.dep.check_required_use() judges the flag lists built by
+    get_use_flags_toggles().
+
+    >>> solver = RequiredUseSolver(["a", "b", "c"], ["^^ ( a b )", "c? ( a )"])
+    >>> solver.count()
+    3
+    >>> list(solver.iter_solutions())
+    [1, 2, 5]
+    >>> 6 in solver, 5 in solver
+    (False, True)
+    >>> solver.get_extreme_index([[0, 1, 2]]), solver.get_extreme_index([[0, 1, 2]], True)
+    (1, 5)
+    """
+
+    def __init__(self, iuse: list[str], ruse: list[str]):
+        self.iuse = list(iuse)
+        self._n = len(self.iuse)
+        # The last flag sits on top of the diagram, so a lo-before-hi walk
+        # visits valid indices in increasing order.
+        self._flag_levels = {
+            flag: self._n - 1 - index for index, flag in enumerate(self.iuse)
+        }
+        self._levels = [self._n, self._n]
+        self._lo = [FALSE, TRUE]
+        self._hi = [FALSE, TRUE]
+        self._unique = {}
+        self._ite_cache = {}
+
+        self._root = self._all_of(
+            [self._compile(node) for node in parse_required_use(ruse)]
+        )
+        self._ite_cache.clear()
+        self._counts = {FALSE: 0, TRUE: 1}
+
+    def _mk(self, level, lo, hi):
+        if lo == hi:
+            return lo
+        key = (level, lo, hi)
+        node = self._unique.get(key)
+        if node is None:
+            node = len(self._levels)
+            self._levels.append(level)
+            self._lo.append(lo)
+            self._hi.append(hi)
+            self._unique[key] = node
+        return node
+
+    def _cofactors(self, node, level):
+        if self._levels[node] == level:
+            return self._lo[node], self._hi[node]
+        return node, node
+
+    def _ite(self, f, g, h):
+        if f == TRUE:
+            return g
+        if f == FALSE:
+            return h
+        if g == h:
+            return g
+        if g == TRUE and h == FALSE:
+            return f
+
+        key = (f, g, h)
+        result = self._ite_cache.get(key)
+        if result is None:
+            level = min(self._levels[f], self._levels[g], self._levels[h])
+            f0, f1 = self._cofactors(f, level)
+            g0, g1 = self._cofactors(g, level)
+            h0, h1 = self._cofactors(h, level)
+            result = self._mk(level, self._ite(f0, g0, h0), self._ite(f1, g1, h1))
+            self._ite_cache[key] = result
+        return result
+
+    def _literal(self, token):
+        negated = token.startswith("!")
+        flag = token[1:] if negated else token
+
+        if not flag:
+            raise invalid_depend_string("USE flag '%s' is not in IUSE" % flag)
+
+        if flag in self._flag_levels:
+            value = self._mk(self._flag_levels[flag], FALSE, TRUE)
+        elif flag.startswith("-") and flag[1:] in self._flag_levels:
+            value = self._mk(self._flag_levels[flag[1:]], TRUE, FALSE)
+        else:
+            value = FALSE
+
+        return self._ite(value, FALSE, TRUE) if negated else value
+
+    def _all_of(self, children):
+        # Children that are not present (inactive conditionals) do not count.
+        value = TRUE
+        for present, child in children:
+            value = self._ite(self._ite(present, child, TRUE), value, FALSE)
+        return value
+
+    def _compile(self, node):
+        """
+        Compile a node into (present, value), where present tells whether
+        the node takes part in the group around it at all.
+        """
+        operator, argument = node
+
+        if operator == "flag":
+            return TRUE, self._literal(argument)
+
+        children = [self._compile(child) for child in argument]
+
+        if operator in GROUP_OPERATORS:
+            values = [self._ite(present, child, FALSE) for present, child in children]
+            if operator == "||":
+                value = FALSE
+                for child in values:
+                    value = self._ite(child, TRUE, value)
+                return TRUE, value
+
+            none_enabled, one_enabled = TRUE, FALSE
+            for child in values:
+                one_enabled = self._ite(child, none_enabled, one_enabled)
+                none_enabled = self._ite(child, FALSE, none_enabled)
+            if operator == "^^":
+                return TRUE, one_enabled
+            return TRUE, self._ite(none_enabled, TRUE, one_enabled)
+
+        value = self._all_of(children)
+
+        if operator == "()":
+            present = FALSE
+            for child_present, _ in children:
+                present = self._ite(child_present, TRUE, present)
+            return present, value
+
+        condition = self._literal(operator[:-1])
+        return condition, self._ite(condition, value, FALSE)
+
+    def _count(self, node):
+        count = self._counts.get(node)
+        if count is None:
+            level = self._levels[node]
+            lo, hi = self._lo[node], self._hi[node]
+            count = (self._count(lo) << (self._levels[lo] - level - 1)) + (
+                self._count(hi) << (self._levels[hi] - level - 1)
+            )
+            self._counts[node] = count
+        return count
+
+    def count(self) -> int:
+        """
+        Number of USE combinations that satisfy REQUIRED_USE.
+        """
+        return self._count(self._root) << self._levels[self._root]
+
+    def __contains__(self, index: int) -> bool:
+        node = self._root
+        while node > TRUE:
+            if index >> (self._n - 1 - self._levels[node]) & 1:
+                node = self._hi[node]
+            else:
+                node = self._lo[node]
+        return node == TRUE
+
+    def _iter_solutions(self, node, level, prefix):
+        if node == FALSE:
+            return
+        if level == self._n:
+            yield prefix
+            return
+        lo, hi = self._cofactors(node, level)
+        yield from self._iter_solutions(lo, level + 1, prefix)
+        yield from self._iter_solutions(
+            hi, level + 1, prefix | 1 << (self._n - 1 - level)
+        )
+
+    def iter_solutions(self) -> Iterable[int]:
+        """
+        Iterate over the indices of all valid USE combinations in increasing order.
+        """
+        return self._iter_solutions(self._root, 0, 0)
+
+    def sample(self, rng: random.Random) -> int:
+        """
+        Draw the index of a valid USE combination uniformly at random.
+
+        Every step follows the lo/hi branch weighted by the number of valid
+        combinations below it, so a draw costs one walk over the flags no matter
+        how small the fraction of valid combinations is.
+
+        :param rng: random number generator to draw from
+        :return: index of the combination
+
+        >>> solver = RequiredUseSolver(["a", "b", "c"], ["^^ ( a b )", "c? ( a )"])
+        >>> rng = random.Random(0)
+        >>> sorted(set(solver.sample(rng) for _ in range(100)))
+        [1, 2, 5]
+        """
+        node = self._root
+        if node == FALSE:
+            raise ValueError("REQUIRED_USE cannot be satisfied")
+
+        index = 0
+        for level in range(self._n):
+            bit = 1 << (self._n - 1 - level)
+            if self._levels[node] == level:
+                lo, hi = self._lo[node], self._hi[node]
+                lo_count = self._count(lo) << (self._levels[lo] - level - 1)
+                hi_count = self._count(hi) << (self._levels[hi] - level - 1)
+                if rng.randrange(lo_count + hi_count) < lo_count:
+                    node = lo
+                else:
+                    node = hi
+                    index |= bit
+            elif rng.getrandbits(1):
+                index |= bit
+
+        return index
+
+    def _restrict(self, node, level, value, cache):
+        if self._levels[node] > level:
+            return node
+        if self._levels[node] == level:
+            return self._hi[node] if value else self._lo[node]
+        result = cache.get(node)
+        if result is None:
+            result = self._mk(
+                self._levels[node],
+                self._restrict(self._lo[node], level, value, cache),
+                self._restrict(self._hi[node], level, value, cache),
+            )
+            cache[node] = result
+        return result
+
+    @property
+    def root(self) -> int:
+        """
+        Handle of the whole constraint, to be narrowed down with restrict().
+        """
+        return self._root
+
+    def restrict(self, node: int, position: int, enabled: bool) -> int:
+        """
+        Narrow a constraint handle down to combinations that set iuse[position] as given.
+
+        :param node: constraint handle, like root or a previous result
+        :param position: position of the flag in iuse
+        :param enabled: value of the flag
+        :return: new constraint handle, FALSE if no valid combination is left
+
+        >>> solver = RequiredUseSolver(["a", "b"], ["^^ ( a b )"])
+        >>> solver.restrict(solver.restrict(solver.root, 0, True), 1, True) == FALSE
+        True
+        """
+        return self._restrict(node, self._n - 1 - position, enabled, {})
+
+    def _min_marked(self, node, levels, marked, cache):
+        """
+        Fewest flags out of levels set to the marked value along any valid
+        path; flags skipped by the diagram are free and stay unmarked.
+        """
+        if node <= TRUE:
+            return 0 if node == TRUE else None
+        if node not in cache:
+            lo = self._min_marked(self._lo[node], levels, marked, cache)
+            hi = self._min_marked(self._hi[node], levels, marked, cache)
+            if self._levels[node] in levels:
+                if marked and hi is not None:
+                    hi += 1
+                elif not marked and lo is not None:
+                    lo += 1
+            cache[node] = min((x for x in (lo, hi) if x is not None), default=None)
+        return cache[node]
+
+    def get_extreme_index(
+        self, groups: list[list[int]], inverted: bool = False
+    ) -> int | None:
+        """
+        Find the valid USE combination with the fewest enabled flags
+        (or, if inverted, the fewest disabled flags).
+
+        Groups of flag positions are minimised one after another and ties are
+        broken in favour of toggling earlier flags, which picks the same
+        combination as the first hit of yield_use_flags_toggles_sorted_split().
+
+        :param groups: lists of flag positions in iuse, in priority order
+        :param inverted: count disabled instead of enabled flags
+        :return: index of the combination, or None if REQUIRED_USE cannot be satisfied
+        """
+        node = self._root
+        if node == FALSE:
+            return None
+
+        marked = not inverted
+        index = 0 if marked else (1 << self._n) - 1
+
+        for group in groups:
+            levels = set(self._n - 1 - position for position in group)
+            budget = self._min_marked(node, levels, marked, {})
+            for position in group:
+                level = self._n - 1 - position
+                candidate = self._restrict(node, level, marked, {})
+                if budget > 0:
+                    rest = self._min_marked(candidate, levels - {level}, marked, {})
+                    if rest is not None and rest + 1 == budget:
+                        node = candidate
+                        budget -= 1
+                        index ^= 1 << position
+                        levels.discard(level)
+                        continue
+                node = self._restrict(node, level, not marked, {})
+                levels.discard(level)
+
+        return index
+
+
+@functools.lru_cache(maxsize=64)
+def _get_required_use_solver(iuse, ruse):
+    return RequiredUseSolver(list(iuse), list(ruse))
+
+
+def get_required_use_solver(iuse: list[str], ruse: list[str]) -> RequiredUseSolver:
+    """
+    Get the compiled REQUIRED_USE of a package, compiling it only once per IUSE/REQUIRED_USE.
+
+    >>> get_required_use_solver(["a", "b"], ["|| ( a b )"]) is get_required_use_solver(["a", "b"], ["|| ( a b )"])
+    True
+    """
+    return _get_required_use_solver(tuple(iuse), tuple(" ".join(ruse).split()))
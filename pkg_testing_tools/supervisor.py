@@ -0,0 +1,303 @@
+import asyncio
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+
+# Longer lines (like progress bars without newlines) are split.
+MAX_LINE_LENGTH = 64 * 1024
+
+# Seconds between SIGTERM and SIGKILL when killing a process tree.
+KILL_GRACE_PERIOD = 10
+
+
+class CommandCancelled(Exception):
+    """
+    Raised by Supervisor.run() when the command was killed by Supervisor.cancel_all().
+    """
+
+
+class StopCommand(Exception):
+    """
+    Raised by an on_line callback of Supervisor.run() to kill the command right away,
+    which then returns its result as usual.
+    """
+
+
+class CommandResult(subprocess.CompletedProcess):
+    """
+    Result of Supervisor.run(), timed_out is 'wall-clock' or 'idle' if the command was killed
+    for exceeding a timeout, None otherwise. rusage is the resource usage of the command
+    and all the processes it waited for, as returned by os.wait4().
+    """
+
+    def __init__(self, args, returncode, timed_out=None, rusage=None):
+        super().__init__(args, returncode)
+        self.timed_out = timed_out
+        self.rusage = rusage
+
+
+def echo_chunk(chunk):
+    sys.stdout.buffer.write(chunk)
+    sys.stdout.buffer.flush()
+
+
+async def read_lines(stream, wait, on_chunk=None):
+    """
+    Yield the lines of a stream, splitting lines longer than MAX_LINE_LENGTH.
+
+    :param wait: coroutine function that waits for a read, like asyncio.wait_for() with a timeout
+    :param on_chunk: called with every chunk as it is read, before it is split into lines
+    """
+    buffer = b""
+
+    while True:
+        chunk = await wait(stream.read(MAX_LINE_LENGTH))
+
+        if chunk and on_chunk is not None:
+            on_chunk(chunk)
+
+        if not chunk:
+            if buffer:
+                yield buffer
+            return
+
+        buffer += chunk
+        lines = buffer.split(b"\n")
+        buffer = lines.pop()
+
+        for line in lines:
+            yield line + b"\n"
+
+        while len(buffer) >= MAX_LINE_LENGTH:
+            yield buffer[:MAX_LINE_LENGTH]
+            buffer = buffer[MAX_LINE_LENGTH:]
+
+
+class SupervisedProcess:
+    """
+    Process started by the Supervisor, reaped with os.wait4() in a thread of its own
+    to get the resource usage of its whole process tree.
+    """
+
+    def __init__(self, loop, popen):
+        self.loop = loop
+        self.popen = popen
+        self.pid = popen.pid
+        self.returncode = None
+        self.rusage = None
+        self.exited = loop.create_future()
+        threading.Thread(target=self.reap, daemon=True).start()
+
+    def reap(self):
+        _, status, rusage = os.wait4(self.pid, 0)
+        returncode = os.waitstatus_to_exitcode(status)
+        # Tell Popen the process is gone, so it doesn't try to reap it.
+        self.popen.returncode = returncode
+        self.loop.call_soon_threadsafe(self.set_exited, returncode, rusage)
+
+    def set_exited(self, returncode, rusage):
+        self.returncode = returncode
+        self.rusage = rusage
+        self.exited.set_result(returncode)
+
+    async def wait(self):
+        return await asyncio.shield(self.exited)
+
+
+def signal_process_group(process, signum):
+    try:
+        os.killpg(process.pid, signum)
+    except ProcessLookupError:
+        pass
+
+
+class Supervisor:
+    """
+    Runs commands on an asyncio event loop in a background thread, so that commands
+    started from any number of threads are watched at once.
+
+    Every command runs in its own session, its output is streamed line by line to
+    callbacks, and its whole process tree is killed when it exceeds a timeout or
+    when cancel_all() is called. Commands whose output nobody reads keep the terminal.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.processes = set()
+        self.cancelled = False
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="supervisor", daemon=True
+        )
+        self.thread.start()
+
+    async def kill(self, process):
+        """
+        Terminate the process group of process, and kill it if it does not exit in time.
+        """
+        if process.exited.done():
+            # Reaped already, its process group id might be reused.
+            return
+
+        signal_process_group(process, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(process.wait(), KILL_GRACE_PERIOD)
+        except asyncio.TimeoutError:
+            signal_process_group(process, signal.SIGKILL)
+            await process.wait()
+
+    async def watch_passthrough(self, cmdline, env, timeout):
+        process = SupervisedProcess(
+            self.loop,
+            subprocess.Popen(cmdline, env=env, start_new_session=True),
+        )
+        self.processes.add(process)
+
+        timed_out = None
+        try:
+            await asyncio.wait_for(process.wait(), timeout)
+        except asyncio.TimeoutError:
+            timed_out = "wall-clock"
+        finally:
+            # Kill on timeouts and cancellation of this coroutine.
+            await self.kill(process)
+            self.processes.discard(process)
+
+        if self.cancelled:
+            raise CommandCancelled()
+
+        return CommandResult(cmdline, process.returncode, timed_out, process.rusage)
+
+    async def watch(self, cmdline, env, on_line, timeout, idle_timeout, echo):
+        if self.cancelled:
+            raise CommandCancelled()
+
+        if on_line is None:
+            return await self.watch_passthrough(cmdline, env, timeout)
+
+        process = SupervisedProcess(
+            self.loop,
+            subprocess.Popen(
+                cmdline,
+                env=env,
+                # An echoed command can still ask questions, like emerge --ask.
+                stdin=None if echo else subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,
+            ),
+        )
+        self.processes.add(process)
+
+        stdout = asyncio.StreamReader(loop=self.loop)
+        transport, _ = await self.loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(stdout, loop=self.loop),
+            process.popen.stdout,
+        )
+
+        deadline = None if timeout is None else self.loop.time() + timeout
+        timed_out = None
+
+        async def wait(read):
+            wait_time = idle_timeout
+            if deadline is not None:
+                wait_time = max(0, deadline - self.loop.time())
+                if idle_timeout is not None:
+                    wait_time = min(wait_time, idle_timeout)
+            return await asyncio.wait_for(read, wait_time)
+
+        output_done = False
+        try:
+            async for line in read_lines(stdout, wait, echo_chunk if echo else None):
+                for callback in on_line:
+                    callback(line)
+            output_done = True
+        except asyncio.TimeoutError:
+            timed_out = (
+                "wall-clock"
+                if deadline is not None and self.loop.time() >= deadline
+                else "idle"
+            )
+        except StopCommand:
+            pass
+        finally:
+            # Kill on timeouts, StopCommand, cancel_all() and exceptions in callbacks.
+            if not output_done or self.cancelled:
+                await self.kill(process)
+            else:
+                await process.wait()
+            transport.close()
+            self.processes.discard(process)
+
+        if self.cancelled:
+            raise CommandCancelled()
+
+        return CommandResult(cmdline, process.returncode, timed_out, process.rusage)
+
+    def run(
+        self, cmdline, env, on_line=(), timeout=None, idle_timeout=None, echo=False
+    ):
+        """
+        Run a command and wait for it.
+
+        :param cmdline: command line
+        :param env: environment of the command
+        :param on_line: callbacks called with every line of output (stdout and stderr), as bytes,
+            which can raise StopCommand to kill the command; None to let the command use
+            stdin, stdout and stderr of this process, like a terminal, without idle_timeout
+        :param timeout: seconds after which the command is killed
+        :param idle_timeout: seconds without output after which the command is killed
+        :param echo: write the output to stdout as it comes, also unfinished lines like
+            prompts, and let the command read stdin
+        :return: CommandResult
+        :raises CommandCancelled: if cancel_all() was called
+        """
+        future = asyncio.run_coroutine_threadsafe(
+            self.watch(cmdline, env, on_line, timeout, idle_timeout, echo), self.loop
+        )
+        try:
+            return future.result()
+        except KeyboardInterrupt:
+            self.cancel_all()
+            raise
+
+    async def kill_all(self):
+        await asyncio.gather(*(self.kill(process) for process in list(self.processes)))
+
+    def cancel_all(self):
+        """
+        Kill the process trees of all running commands and refuse to start new ones.
+        Can be called from any thread.
+        """
+        if self.cancelled:
+            return
+
+        self.cancelled = True
+        if self.processes:
+            logging.warning("Killing {} running commands.".format(len(self.processes)))
+
+        asyncio.run_coroutine_threadsafe(self.kill_all(), self.loop).result()
+
+    def reset(self):
+        """
+        Start commands again after cancel_all(), once the cancelled ones are gone.
+        """
+        self.cancelled = False
+
+
+_supervisor = None
+_supervisor_lock = threading.Lock()
+
+
+def get_supervisor():
+    """
+    The Supervisor of this process, started on first use.
+    """
+    global _supervisor
+
+    with _supervisor_lock:
+        if _supervisor is None:
+            _supervisor = Supervisor()
+        return _supervisor
@@ -6,34 +6,107 @@ import os
 import shlex
 import subprocess
 import sys
+import time
 from contextlib import ExitStack
 
-import portage
-
-from .tmp import get_etc_portage_tmp_file
-
-
-def run_cmd(cmdline, env, quiet, pretend):
+from .capture import (
+    DEFAULT_TAIL_SIZE,
+    FatalErrorWatcher,
+    MergeCounter,
+    OutputCapture,
+    PhaseTimer,
+    log_captured_failure,
+    open_spill_file,
+)
+from .job import get_job_log_name, get_job_use_flags
+from .portage_api import get_portage, get_settings
+from .supervisor import get_supervisor
+from .tmp import JOB_DIRECTORIES, get_etc_portage_tmp_file
+
+
+def run_cmd(
+    cmdline,
+    env,
+    quiet,
+    pretend,
+    log_path=None,
+    tail_size=DEFAULT_TAIL_SIZE,
+    timeout=None,
+    idle_timeout=None,
+    on_line=(),
+):
+    """
+    Run a command through the Supervisor. Its output is echoed, or when quiet,
+    streamed through a bounded capture and only the interesting parts are logged on failure.
+
+    :param log_path: file to write the whole output to when quiet
+    :param tail_size: bytes of output to keep in memory when quiet
+    :param timeout: seconds after which the command is killed
+    :param idle_timeout: seconds without output after which the command is killed
+    :param on_line: additional callbacks called with every line of output, as bytes
+    :return: CommandResult, or None when pretending
+    :raises CommandCancelled: if the Supervisor was cancelled, e.g. on --fail-fast
+    """
     result = None
     logging.debug("Running command: {}".format(" ".join(cmdline)))
     if not pretend:
-        result = subprocess.run(cmdline, env=env, capture_output=quiet, text=True)
+        if quiet:
+            with open_spill_file(log_path) as spill:
+                capture = OutputCapture(spill, tail_size)
+                result = get_supervisor().run(
+                    cmdline,
+                    env,
+                    [capture.feed] + list(on_line),
+                    timeout,
+                    idle_timeout,
+                )
+            if result.returncode != 0:
+                log_captured_failure(result, capture, spill.name)
+            elif log_path is None:
+                os.unlink(spill.name)
+        elif on_line or idle_timeout is not None:
+            result = get_supervisor().run(
+                cmdline, env, list(on_line), timeout, idle_timeout, echo=True
+            )
+        else:
+            # Nothing reads the output, so the command keeps the terminal, with its colours and prompts.
+            result = get_supervisor().run(cmdline, env, None, timeout)
+        if result.timed_out == "wall-clock":
+            logging.error("Command killed after running longer than its timeout.")
+        elif result.timed_out == "idle":
+            logging.error("Command killed after printing nothing for too long.")
     logging.debug("Command finished.")
-    if quiet and result is not None:
-        if result.returncode != 0:
-            logging.error("Command failed with exit code %d", result.returncode)
-            if result.stdout:
-                logging.error("STDOUT: %s", result.stdout)
-            if result.stderr:
-                logging.error("STDERR: %s", result.stderr)
     return result
 
 
-def run_testing(job, args):
-    global_features = []
+def add_resource_usage(resources, rusage):
+    """
+    Add the CPU time and peak memory of rusage (as returned by os.wait4()) to resources.
 
-    time_started = datetime.datetime.now().replace(microsecond=0).isoformat()
+    >>> import resource
+    >>> resources = {"user_time": 1.0, "system_time": 0.5, "max_rss": 4096}
+    >>> add_resource_usage(resources, resource.struct_rusage((2.0, 0.25, 2) + (0,) * 13))
+    >>> resources
+    {'user_time': 3.0, 'system_time': 0.75, 'max_rss': 4096}
+    """
+    if rusage is None:
+        return
+
+    resources["user_time"] += rusage.ru_utime
+    resources["system_time"] += rusage.ru_stime
+    # ru_maxrss is in KiB on Linux
+    resources["max_rss"] = max(resources["max_rss"], rusage.ru_maxrss * 1024)
+
+
+def get_emerge_cmdline(job, args, binpkg_cache=False):
+    """
+    emerge command line testing a job.
 
+    :param job: job as defined by define_jobs()
+    :param args: parsed command line arguments
+    :param binpkg_cache: whether binary packages come from a BinpkgCache, which holds
+        binary packages of the same version with different USE flags
+    """
     emerge_cmdline = [
         "emerge",
         "--verbose",
@@ -44,15 +117,6 @@ def run_testing(job, args):
         "--backtrack",
         "300",
     ]
-    unmerge_cmdline = [
-        "emerge",
-        "--rage-clean",
-        job["cp"],
-    ]
-    depclean_cmdline = [
-        "emerge",
-        "--depclean",
-    ]
 
     if args.append_emerge:
         emerge_cmdline += shlex.split(args.append_emerge)
@@ -61,30 +125,58 @@ def run_testing(job, args):
 
     if args.binpkg:
         emerge_cmdline.append("--usepkg")
-        global_features.append("buildpkg")
+        if binpkg_cache:
+            emerge_cmdline.append("--binpkg-respect-use=y")
 
     if args.slow:
         emerge_cmdline.append("--jobs=1")
-        global_features.append("-distcc")
 
-    if args.ccache:
-        if not portage.settings.get("CCACHE_DIR") or not portage.settings.get(
-            "CCACHE_SIZE"
-        ):
-            logging.critical("The CCACHE_DIR and/or CCACHE_SIZE is not set!")
-            sys.exit(1)
+    emerge_cmdline.append(job["cpv"])
 
-        global_features.append("ccache")
+    return emerge_cmdline
 
-    emerge_cmdline.append(job["cpv"])
 
-    with ExitStack() as stack:
-        tmp_files = {}
+class JobConfig:
+    """
+    FEATURES, package.env and package.use entries of a job, in temporary files in
+    config_root/etc/portage that are rewritten in place for every job run with them,
+    and removed by close().
+    """
 
-        for directory in ["env", "package.env", "package.use"]:
-            tmp_files[directory] = stack.enter_context(
-                get_etc_portage_tmp_file(directory, args.prefix)
-            )
+    def __init__(self, config_root):
+        self.tmp_files = {}
+        with ExitStack() as stack:
+            for directory in JOB_DIRECTORIES:
+                self.tmp_files[directory] = stack.enter_context(
+                    get_etc_portage_tmp_file(directory, config_root)
+                )
+            self.stack = stack.pop_all()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.stack.close()
+
+    def clear(self):
+        """
+        Remove the entries of the previous job.
+        """
+        for handler in self.tmp_files.values():
+            handler.seek(0)
+            handler.truncate()
+            handler.flush()
+
+    def write(self, job):
+        """
+        Replace the entries of the previous job by those of job.
+
+        :param job: job as defined by define_jobs()
+        """
+        self.clear()
 
         tested_cpv_features = ["qa-unresolved-soname-deps", "multilib-strict"]
 
@@ -92,45 +184,143 @@ def run_testing(job, args):
             tested_cpv_features.append("test")
 
         if tested_cpv_features:
-            tmp_files["env"].write(
+            self.tmp_files["env"].write(
                 'FEATURES="{}"\n'.format(" ".join(tested_cpv_features))
             )
 
-        env_files = [os.path.basename(tmp_files["env"].name)]
+        env_files = [os.path.basename(self.tmp_files["env"].name)]
 
         if job["extra_env_files"]:
             env_files.append(job["extra_env_files"])
 
-        tmp_files["package.env"].write(
+        self.tmp_files["package.env"].write(
             "{cp} {env_files}\n".format(cp=job["cp"], env_files=" ".join(env_files))
         )
 
-        if job["use_flags"]:
-            tmp_files["package.use"].write(
+        use_flags = get_job_use_flags(job)
+
+        if use_flags:
+            self.tmp_files["package.use"].write(
                 "{prefix} {flags}\n".format(
                     prefix=(
                         "*/*" if job["use_flags_scope"] == "global" else job["cpv"]
                     ),
-                    flags=" ".join(job["use_flags"]),
+                    flags=" ".join(use_flags),
                 )
             )
 
-        for handler in tmp_files:
-            tmp_files[handler].flush()
+        for handler in self.tmp_files.values():
+            handler.flush()
+
+
+def write_job_config(job, stack, config_root):
+    """
+    Write the FEATURES, package.env and package.use entries of a job to temporary files
+    in config_root/etc/portage, which are removed when stack is closed.
+
+    :param job: job as defined by define_jobs()
+    :param stack: ExitStack owning the temporary files
+    :param config_root: prefix of the portage configuration to write to
+    """
+    stack.enter_context(JobConfig(config_root)).write(job)
+
+
+def run_testing(
+    job,
+    args,
+    config_root=None,
+    makeopts=None,
+    job_config=None,
+    binpkg_cache=None,
+    snapshot=None,
+):
+    """
+    Run a single testing job.
+
+    :param job: job as defined by define_jobs()
+    :param args: parsed command line arguments
+    :param config_root: PORTAGE_CONFIGROOT to write the job's configuration to and run emerge with, defaults to args.prefix
+    :param makeopts: MAKEOPTS to run emerge with, overridden by --slow
+    :param job_config: JobConfig in config_root to write the job's configuration to, temporary files are used if not given
+    :param binpkg_cache: BinpkgCache to take and put binary packages of dependencies, instead of PKGDIR
+    :param snapshot: VdbSnapshot to bring the installed packages back to after the job
+    :return: report entry
+    """
+    global_features = []
+
+    time_started = datetime.datetime.now().replace(microsecond=0).isoformat()
+
+    emerge_cmdline = get_emerge_cmdline(job, args, binpkg_cache is not None)
+    unmerge_cmdline = [
+        "emerge",
+        "--rage-clean",
+        job["cp"],
+    ]
+    depclean_cmdline = [
+        "emerge",
+        "--depclean",
+    ]
+
+    if args.binpkg:
+        global_features.append("buildpkg")
+
+    if args.slow:
+        global_features.append("-distcc")
+
+    if args.ccache:
+        settings = get_settings()
+        if not settings.get("CCACHE_DIR") or not settings.get("CCACHE_SIZE"):
+            logging.critical("The CCACHE_DIR and/or CCACHE_SIZE is not set!")
+            sys.exit(1)
+
+        global_features.append("ccache")
+
+    use_flags = get_job_use_flags(job)
+
+    log_path = None
+    if args.log_dir:
+        log_path = os.path.join(args.log_dir, get_job_log_name(job))
+
+    durations = {}
+    resources = {"user_time": 0.0, "system_time": 0.0, "max_rss": 0}
+
+    def run_timed(name, cmdline, env, *run_cmd_args):
+        started = time.monotonic()
+        result = run_cmd(cmdline, env, args.quiet, args.pretend, *run_cmd_args)
+        durations[name] = durations.get(name, 0) + time.monotonic() - started
+        if result is not None:
+            add_resource_usage(resources, result.rusage)
+        return result
+
+    with ExitStack() as stack:
+        if job_config is None:
+            write_job_config(
+                job, stack, args.prefix if config_root is None else config_root
+            )
+        else:
+            job_config.write(job)
 
         env = os.environ.copy()
 
+        if config_root is not None:
+            env["PORTAGE_CONFIGROOT"] = config_root
+
+        if binpkg_cache is not None:
+            binpkg_cache.set_env(env)
+
         if args.unmerge:
-            run_cmd(unmerge_cmdline, env, args.quiet, args.pretend)
+            run_timed("unmerge", unmerge_cmdline, env)
 
         if args.depclean:
-            run_cmd(depclean_cmdline, env, args.quiet, args.pretend)
+            run_timed("depclean", depclean_cmdline, env)
 
         if args.test_feature_scope == "force":
             env["EBUILD_FORCE_TEST"] = "1"
 
         if args.slow:
             env["MAKEOPTS"] = "-j1 -l1"
+        elif makeopts is not None:
+            env["MAKEOPTS"] = makeopts
 
         if global_features:
             if "FEATURES" in env:
@@ -140,18 +330,91 @@ def run_testing(job, args):
             else:
                 env["FEATURES"] = " ".join(global_features)
 
-        emerge_result = run_cmd(emerge_cmdline, env, args.quiet, args.pretend)
+        phase_timer = PhaseTimer()
+        merge_counter = MergeCounter()
+        on_line = [phase_timer.feed, merge_counter.feed]
+        fatal_error_watcher = None
+        # The job failed for good once a phase failed, don't wait for the rest of emerge.
+        if args.fail_fast or args.prune_failing:
+            fatal_error_watcher = FatalErrorWatcher()
+            on_line.append(fatal_error_watcher.feed)
+        with ExitStack() as cache_stack:
+            # Keeps the binary packages emerge picked from being evicted meanwhile.
+            if binpkg_cache is not None:
+                cache_stack.enter_context(binpkg_cache.use())
+            emerge_result = run_timed(
+                "emerge",
+                # Its output is read through a pipe, which emerge would print without colours.
+                (
+                    emerge_cmdline + ["--color=y"]
+                    if not args.quiet and sys.stdout.isatty()
+                    else emerge_cmdline
+                ),
+                env,
+                log_path,
+                int(args.tail_size * 1024 * 1024),
+                args.timeout * 60 if args.timeout else None,
+                args.idle_timeout * 60 if args.idle_timeout else None,
+                on_line,
+            )
+
+        fatal_error = None
+        if fatal_error_watcher is not None and fatal_error_watcher.package:
+            fatal_error = {
+                "package": fatal_error_watcher.package,
+                "phase": fatal_error_watcher.phase,
+            }
+            logging.error(
+                "Stopped emerge after {package} failed in its {phase} phase.".format(
+                    **fatal_error
+                )
+            )
+
+    if snapshot is not None:
+        # Without the job's package.use, FEATURES and MAKEOPTS.
+        if job_config is not None:
+            job_config.clear()
+        env = os.environ.copy()
+        if config_root is not None:
+            env["PORTAGE_CONFIGROOT"] = config_root
+        with ExitStack() as cache_stack:
+            if binpkg_cache is not None:
+                binpkg_cache.set_env(env)
+                cache_stack.enter_context(binpkg_cache.use())
+            for cmdline in snapshot.get_restore_cmdlines():
+                run_timed("restore", cmdline, env)
+
+    binpkgs = None
+    if binpkg_cache is not None:
+        # The tested package is always built from source, see --usepkg-exclude.
+        dependencies = [
+            cpv
+            for cpv in merge_counter.source
+            if get_portage().versions.cpv_getkey(cpv) != job["cp"]
+        ]
+        binpkg_cache.record(merge_counter.binary, dependencies)
+        binpkg_cache.evict(blocking=False)
+        binpkgs = {"hits": len(merge_counter.binary), "misses": len(dependencies)}
 
     return {
-        "use_flags": " ".join(job["use_flags"]),
+        "use_flags": " ".join(use_flags),
         "exit_code": 0 if emerge_result is None else emerge_result.returncode,
-        "features": portage.settings.get("FEATURES"),
-        "emerge_default_opts": portage.settings.get("EMERGE_DEFAULT_OPTS"),
+        "features": get_settings().get("FEATURES"),
+        "emerge_default_opts": get_settings().get("EMERGE_DEFAULT_OPTS"),
         "emerge_cmdline": " ".join(emerge_cmdline),
         "test_feature_toggle": job["test_feature_toggle"],
         "atom": job["cpv"],
+        "cp": job["cp"],
+        "cpv": job["resolved_cpv"],
+        "inputs": job["inputs"],
+        "log": log_path,
+        "timed_out": None if emerge_result is None else emerge_result.timed_out,
         "time": {
             "started": time_started,
             "finished": datetime.datetime.now().replace(microsecond=0).isoformat(),
         },
+        "timings": {"commands": durations, **phase_timer.get_timings()},
+        "resources": resources,
+        "binpkgs": binpkgs,
+        "fatal_error": fatal_error,
     }
@@ -1,7 +1,11 @@
 import logging
 import os
 import sys
-from tempfile import NamedTemporaryFile
+from contextlib import contextmanager
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+
+# Directories run_testing() writes to, which need to be private to each job.
+JOB_DIRECTORIES = ["env", "package.env", "package.use"]
 
 
 def get_etc_portage_tmp_file(directory_name, prefix):
@@ -22,3 +26,41 @@ def get_etc_portage_tmp_file(directory_name, prefix):
     os.chmod(handler.name, 0o644 & ~umask)
 
     return handler
+
+
+@contextmanager
+def get_portage_configroot(prefix):
+    """
+    Create a temporary PORTAGE_CONFIGROOT that mirrors prefix/etc/portage through symlinks.
+
+    The directories run_testing() writes to are private directories that link
+    to the original entries, so concurrently running jobs don't see each
+    other's package.use/package.env files, while everything else (including
+    the package.accept_keywords and repos.conf files written for the whole
+    session) is shared.
+    """
+    source_location = os.path.abspath(prefix + "/etc/portage")
+
+    if not os.path.isdir(source_location):
+        logging.critical(
+            "The location {} needs to exist and be a directory".format(source_location)
+        )
+        sys.exit(1)
+
+    with TemporaryDirectory(prefix="zzz_pkg_testing_tool_configroot_") as config_root:
+        os.chmod(config_root, 0o755)
+        target_location = os.path.join(config_root, "etc/portage")
+        os.makedirs(target_location)
+
+        for name in os.listdir(source_location):
+            source = os.path.join(source_location, name)
+            target = os.path.join(target_location, name)
+
+            if name in JOB_DIRECTORIES and os.path.isdir(source):
+                os.mkdir(target)
+                for entry in os.listdir(source):
+                    os.symlink(os.path.join(source, entry), os.path.join(target, entry))
+            else:
+                os.symlink(source, target)
+
+        yield config_root
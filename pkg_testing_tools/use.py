@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 
 import itertools
+import logging
 import random
-from typing import Iterable
+from typing import Collection, Iterable
 
-import portage
+from .portage_api import get_portdb
+from .solver import FALSE, RequiredUseSolver, get_required_use_solver
+
+COVERING_STRENGTHS = {"pairwise": 2, "3wise": 3}
 
 
 def iuse_match_always_true(flag):
@@ -77,20 +81,23 @@ def atom_to_cpv(atom):
     Get the cpv for an atom.
     """
 
-    matched = portage.db[portage.root]["porttree"].dbapi.match(atom)
+    matched = get_portdb().match(atom)
 
     if len(matched) == 0:
         return None
     return matched[0]
 
 
-def get_package_flags(cpv):
+def get_package_flags(cpv, aux=None):
     """
     Get the use flags and required use flags for a package.
+
+    :param cpv: package
+    :param aux: IUSE and REQUIRED_USE of the package, if already fetched
     """
-    flags = portage.db[portage.root]["porttree"].dbapi.aux_get(
-        cpv, ["IUSE", "REQUIRED_USE"]
-    )
+    if aux is None:
+        aux = get_portdb().aux_get(cpv, ["IUSE", "REQUIRED_USE"])
+    flags = aux
     use_flags = strip_use_flags(flags[0].split())
     use_flags = filter_out_use_flags(use_flags)
     use_flags = sorted(use_flags)
@@ -169,7 +176,7 @@ def get_use_flags_toggles(
     str_disabled = "-" if not inverted else ""
 
     for i in range(len(iuse)):
-        if (2**i) & index:
+        if index >> i & 1:
             on_off_switches.append(str_enabled)
         else:
             on_off_switches.append(str_disabled)
@@ -179,22 +186,276 @@ def get_use_flags_toggles(
     return flags
 
 
-def get_use_combinations(
+def yield_covered_interactions(
+    index: int, positions: list[int], strength: int
+) -> Iterable[tuple[int, ...]]:
+    """
+    Generate the interactions of `strength` flag states that a use flag combination covers.
+
+    A flag state is encoded as 2 * position + enabled.
+
+    :param index: index of the use flag combination
+    :param positions: sorted positions of the use flags to consider
+    :param strength: number of flags per interaction
+    :return: iterator yielding sorted tuples of encoded flag states
+
+    >>> list(yield_covered_interactions(1, [0, 1, 2], 2))
+    [(1, 2), (1, 4), (2, 4)]
+    """
+    states = [2 * position + (index >> position & 1) for position in positions]
+    yield from itertools.combinations(states, strength)
+
+
+def get_covering_use_combinations(
+    solver: RequiredUseSolver,
+    strength: int,
+    rng: random.Random,
+    initial_combinations: Iterable[int] = (),
+    max_use_combinations: int = -1,
+    candidates: int = 8,
+) -> list[int]:
+    """
+    Build a covering array, i.e. use flag combinations such that every valid combination
+    of `strength` flag states shows up in at least one of them.
+
+    Rows are built greedily (AETG style): each candidate row starts from a not yet covered
+    interaction and fixes the remaining flags in random order, choosing the state that covers
+    the most new interactions while REQUIRED_USE can still be satisfied.
+    The best of several candidate rows is kept.
+
+    :param solver: compiled REQUIRED_USE
+    :param strength: number of flags per interaction, 2 for pairwise
+    :param rng: random number generator
+    :param initial_combinations: indices of combinations that are tested anyway
+    :param max_use_combinations: maximum number of combinations to return, -1 for no limit
+    :param candidates: number of candidate rows per generated combination
+    :return: list of indices of the use flag combinations
+
+    >>> solver = RequiredUseSolver(["a", "b", "c", "d"], ["?? ( a b )"])
+    >>> rows = get_covering_use_combinations(solver, 2, random.Random(0))
+    >>> all(row in solver for row in rows)
+    True
+    >>> covered = set()
+    >>> for row in rows:
+    ...     covered.update(yield_covered_interactions(row, [0, 1, 2, 3], 2))
+    >>> len(covered)
+    23
+    """
+    positions = list(range(len(solver.iuse)))
+    strength = min(strength, len(positions))
+
+    if strength == 0:
+        return []
+
+    # Bit masks over the (strength - 1)-subsets of flag states, per flag state,
+    # so the gain of a flag state is a single popcount.
+    subset_bits = {}
+    for combination in itertools.combinations(positions, strength - 1):
+        for states in itertools.product((0, 1), repeat=strength - 1):
+            subset = tuple(2 * p + state for p, state in zip(combination, states))
+            subset_bits[subset] = 1 << len(subset_bits)
+
+    uncovered = set()
+    masks = [0] * (2 * len(positions))
+    for combination in itertools.combinations(positions, strength):
+        for states in itertools.product((0, 1), repeat=strength):
+            interaction = tuple(2 * p + state for p, state in zip(combination, states))
+            uncovered.add(interaction)
+            for i, code in enumerate(interaction):
+                masks[code] |= subset_bits[interaction[:i] + interaction[i + 1 :]]
+
+    def cover(interactions):
+        for interaction in interactions:
+            if interaction in uncovered:
+                uncovered.remove(interaction)
+                for i, code in enumerate(interaction):
+                    masks[code] &= ~subset_bits[interaction[:i] + interaction[i + 1 :]]
+
+    for index in initial_combinations:
+        cover(yield_covered_interactions(index, positions, strength))
+
+    use_combinations = []
+
+    while uncovered and (
+        max_use_combinations < 0 or len(use_combinations) < max_use_combinations
+    ):
+        best_index, best_gain = None, 0
+
+        for seed in rng.sample(list(uncovered), min(candidates, len(uncovered))):
+            node = solver.root
+            for code in seed:
+                node = solver.restrict(node, code // 2, bool(code % 2))
+
+            if node == FALSE:
+                # Forbidden by REQUIRED_USE, nothing to cover.
+                cover([seed])
+                continue
+
+            fixed = []
+            fixed_mask = 0
+            gain = 0
+
+            seed_positions = set(code // 2 for code in seed)
+            order = [
+                position for position in positions if position not in seed_positions
+            ]
+            rng.shuffle(order)
+
+            for position in [code // 2 for code in seed] + order:
+                best = None
+                for enabled in rng.sample((False, True), 2):
+                    if position in seed_positions:
+                        if 2 * position + enabled not in seed:
+                            continue
+                        candidate = node
+                    else:
+                        candidate = solver.restrict(node, position, enabled)
+                        if candidate == FALSE:
+                            continue
+
+                    code_gain = (masks[2 * position + enabled] & fixed_mask).bit_count()
+
+                    if best is None or code_gain > best[0]:
+                        best = (code_gain, 2 * position + enabled, candidate)
+
+                code_gain, code, node = best
+                gain += code_gain
+                for others in itertools.combinations(fixed, strength - 2):
+                    fixed_mask |= subset_bits[tuple(sorted(others + (code,)))]
+                fixed.append(code)
+
+            if gain > best_gain:
+                best_index = sum(1 << (code // 2) for code in fixed if code % 2)
+                best_gain = gain
+
+        if best_index is not None:
+            use_combinations.append(best_index)
+            cover(yield_covered_interactions(best_index, positions, strength))
+
+    if uncovered:
+        logging.warning(
+            "Stopped at {} USE flag combinations, up to {} {}-flag interactions are not covered.".format(
+                len(use_combinations), len(uncovered), strength
+            )
+        )
+
+    return use_combinations
+
+
+def get_use_combination_indices(
     iuse: list[str],
     ruse: list[str],
     max_use_combinations: int,
     add_sparse_use: bool = False,
     add_dense_use: bool = False,
-) -> list[list[str]]:
+    rng: random.Random | None = None,
+    strategy: str = "random",
+    tested: Collection[int] = (),
+) -> list[int]:
     """
-    Iterate through all possible use flag combinations and return the ones that satisfy the required use constraints specified by the ruse parameter.
+    Return use flag combinations that satisfy the required use constraints specified by the ruse parameter,
+    as indices for get_use_flags_toggles(), i.e. bit masks of the enabled flags.
+
+    REQUIRED_USE is compiled once per package by RequiredUseSolver, so only valid combinations are enumerated
+    and the sparse/dense combinations are looked up directly instead of walking all 2^n toggles.
+    Random combinations are drawn uniformly out of the valid ones, without a rejection loop.
+    With a covering strategy, max_use_combinations only caps the size of the covering array.
+    Combinations in tested are avoided: random sampling prefers untested combinations,
+    and covering arrays only cover interactions that none of them covered yet.
 
     :param iuse: list of use flags
     :param ruse: list of required use flags
     :param max_use_combinations: maximum number of use flag combinations to return
     :param add_sparse_use: add the combination with the fewest enabled USE flags that satisfies constraints
     :param add_dense_use: add the combination with the most enabled USE flags that satisfies constraints
-    :return: list of valid use flag combinations
+    :param rng: random number generator for sampling, unseeded if not given
+    :param strategy: 'random', or 'pairwise'/'3wise' to return a covering array (see get_covering_use_combinations)
+    :param tested: indices of combinations that were tested before
+    :return: list of distinct indices of valid use flag combinations
+
+    >>> get_use_combination_indices(["flag1", "flag2", "flag3"], ["flag1"], 999)
+    [1, 3, 5, 7]
+    >>> sorted(get_use_combination_indices(["flag1", "flag2", "flag3"], ["flag1"], 2, tested=[1, 3]))
+    [5, 7]
+    """
+    all_combinations_count = 2 ** len(iuse)
+
+    solver = get_required_use_solver(iuse, ruse)
+
+    # dict as an ordered set
+    valid_use_flags_combinations = {}
+
+    if rng is None:
+        rng = random.Random()
+
+    # single_target flags are toggled last, like in yield_use_flags_toggles_sorted_split()
+    sorted_positions = [i for i, use in enumerate(iuse) if "single_target" not in use]
+    unsorted_positions = [i for i, use in enumerate(iuse) if "single_target" in use]
+
+    for add, inverted in [(add_sparse_use, False), (add_dense_use, True)]:
+        if not add:
+            continue
+
+        index = solver.get_extreme_index(
+            [sorted_positions, unsorted_positions], inverted
+        )
+
+        if index is not None:
+            valid_use_flags_combinations[index] = None
+
+    if strategy in COVERING_STRENGTHS:
+        candidates = get_covering_use_combinations(
+            solver,
+            COVERING_STRENGTHS[strategy],
+            rng,
+            list(valid_use_flags_combinations) + list(tested),
+            (
+                max_use_combinations - len(valid_use_flags_combinations)
+                if max_use_combinations >= 0
+                else -1
+            ),
+        )
+    elif max_use_combinations >= 0 and all_combinations_count > max_use_combinations:
+        tested = set(tested)
+        if solver.count() <= 2 * max_use_combinations + len(tested):
+            # Few (untested) valid combinations, shuffle them instead of drawing duplicates over and over.
+            candidates = list(solver.iter_solutions())
+            rng.shuffle(candidates)
+            # Stable, so untested combinations come first but stay shuffled.
+            candidates.sort(key=lambda index: index in tested)
+        else:
+            # More than 2 * max_use_combinations untested ones left, skipping tested ones terminates quickly.
+            candidates = (
+                index
+                for index in (solver.sample(rng) for _ in itertools.count())
+                if index not in tested
+            )
+    else:
+        max_use_combinations = -1
+        candidates = solver.iter_solutions()
+
+    for index in candidates:
+        if 0 <= max_use_combinations <= len(valid_use_flags_combinations):
+            break
+
+        valid_use_flags_combinations[index] = None
+
+    return list(valid_use_flags_combinations)
+
+
+def get_use_combinations(
+    iuse: list[str],
+    ruse: list[str],
+    max_use_combinations: int,
+    add_sparse_use: bool = False,
+    add_dense_use: bool = False,
+    rng: random.Random | None = None,
+    strategy: str = "random",
+) -> list[list[str]]:
+    """
+    Return use flag combinations that satisfy the required use constraints specified by the ruse parameter.
+
+    Same as get_use_combination_indices(), but with the combinations rendered by get_use_flags_toggles().
 
     >>> get_use_combinations(["flag1", "flag2", "flag3"], ["flag1"], 999)
     [['flag1', '-flag2', '-flag3'], ['flag1', 'flag2', '-flag3'], ['flag1', '-flag2', 'flag3'], ['flag1', 'flag2', 'flag3']]
@@ -212,76 +473,44 @@ def get_use_combinations(
     [['-flag1', 'flag2', 'flag3']]
     >>> get_use_combinations(["flag1", "flag2"], [], 999, True, True) # doctest: +ELLIPSIS
     [['-flag1', '-flag2'], ['flag1', 'flag2'], [...], [...]]
+    >>> len(get_use_combinations(["flag1", "flag2", "flag3", "flag4"], ["^^ ( flag1 flag2 )"], -1, strategy="pairwise")) < 8
+    True
 
     """
-    all_combinations_count = 2 ** len(iuse)
+    return [
+        get_use_flags_toggles(index, iuse)
+        for index in get_use_combination_indices(
+            iuse,
+            ruse,
+            max_use_combinations,
+            add_sparse_use,
+            add_dense_use,
+            rng,
+            strategy,
+        )
+    ]
+
+
+def parse_use_flags(iuse: list[str], use_flags: str) -> int:
+    """
+    Inverse of render_use_flags(): bit mask of the flags enabled in use_flags.
 
-    valid_use_flags_combinations = []
-
-    if add_sparse_use:
-        for flags in yield_use_flags_toggles_sorted_split(
-            [use for use in iuse if "single_target" not in use],
-            [use for use in iuse if "single_target" in use],
-            False,
-        ):
-            if (
-                flags not in valid_use_flags_combinations
-                and portage.dep.check_required_use(
-                    " ".join(ruse), flags, iuse_match_always_true
-                )
-            ):
-                valid_use_flags_combinations.append(flags)
-                break  # early quit O(2^n) loop
-
-    if add_dense_use:
-        for flags in yield_use_flags_toggles_sorted_split(
-            [use for use in iuse if "single_target" not in use],
-            [use for use in iuse if "single_target" in use],
-            True,
-        ):
-            if (
-                flags not in valid_use_flags_combinations
-                and portage.dep.check_required_use(
-                    " ".join(ruse), flags, iuse_match_always_true
-                )
-            ):
-                valid_use_flags_combinations.append(flags)
-                break  # early quit O(2^n) loop
-
-    if max_use_combinations >= 0 and all_combinations_count > max_use_combinations:
-        random.seed()
-        checked_combinations = set()
-
-        while (
-            len(valid_use_flags_combinations) < max_use_combinations
-            and len(checked_combinations) < all_combinations_count
-        ):
-            index = random.randint(0, all_combinations_count - 1)
-
-            if index in checked_combinations:
-                continue
-            else:
-                checked_combinations.add(index)
-
-            flags = get_use_flags_toggles(index, iuse)
-
-            if (
-                flags not in valid_use_flags_combinations
-                and portage.dep.check_required_use(
-                    " ".join(ruse), flags, iuse_match_always_true
-                )
-            ):
-                valid_use_flags_combinations.append(flags)
-    else:
-        for index in range(0, all_combinations_count):
-            flags = get_use_flags_toggles(index, iuse)
-
-            if (
-                flags not in valid_use_flags_combinations
-                and portage.dep.check_required_use(
-                    " ".join(ruse), flags, iuse_match_always_true
-                )
-            ):
-                valid_use_flags_combinations.append(flags)
-
-    return valid_use_flags_combinations
+    >>> parse_use_flags(["a", "b", "c"], "-a b c")
+    6
+    """
+    enabled = set(flag for flag in use_flags.split() if not flag.startswith("-"))
+    return sum(1 << i for i, flag in enumerate(iuse) if flag in enabled)
+
+
+def render_use_flags(iuse: list[str], index: int | None) -> list[str]:
+    """
+    Render a use flag combination for package.use, None meaning the default flags.
+
+    >>> render_use_flags(["flag1", "flag2"], 2)
+    ['-flag1', 'flag2']
+    >>> render_use_flags([], None)
+    []
+    """
+    if index is None:
+        return []
+    return get_use_flags_toggles(index, iuse)